@@ -0,0 +1,47 @@
+#! /usr/bin/env python3
+
+# Import various modules
+import argparse
+import sys
+from glob import glob
+import numpy as np
+
+# Import local modules from the file module.py in the current directory
+from module import *
+
+# Define and read arguments for the script
+parser = argparse.ArgumentParser(description="Average raw snapshots into the mean fields used by the quantities")
+parser.add_argument("-v", "--verbose", action="store_true")
+parser.add_argument("-c", "--case", help="Parameter file for the case")
+parser.add_argument("-a", "--average", help="Parameter file for the mean fields")
+parser.add_argument("-s", "--snapshot", nargs='+', help="Snapshot folder(s) or glob pattern(s), processed in sorted order")
+parser.add_argument("--checkpoint", help="Checkpoint file to resume an interrupted run")
+parser.add_argument("--every", type=int, default=10, help="Number of snapshots between two checkpoints")
+parser.add_argument("-o", "--output", help="Folder for the mean fields (default: raw data folder of the case)")
+args = parser.parse_args()
+
+# User must provide the case, the mean fields and the snapshots
+if not (args.case and args.average and args.snapshot):
+   print("Error: a case, a mean fields parameter file and snapshot(s) must be provided.")
+   sys.exit(1)
+
+# Expand the glob patterns
+snapshots = []
+for pattern in args.snapshot:
+   snapshots.extend(sorted(glob(pattern)) or [pattern])
+
+# Average the snapshots
+case = setup(args.case)
+try:
+   avg = averager(case, args.average, args.checkpoint)
+except ValueError as err:
+   print(err)
+   sys.exit(1)
+if args.verbose:
+   print(avg)
+   print("Number of snapshot(s): " + np.str(len(snapshots)))
+   print("Already processed: " + np.str(len(avg.done)))
+avg.run(snapshots, args.every)
+avg.save(args.output)
+if args.verbose:
+   print("Mean fields written after " + np.str(avg.n) + " snapshot(s)")
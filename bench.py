@@ -0,0 +1,172 @@
+#! /usr/bin/env python3
+
+# Import various modules
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+from glob import glob
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from os.path import join as opjoin
+here = os.path.dirname(os.path.abspath(__file__))
+
+# Import local modules from the file module.py in the current directory
+from module import *
+
+# Small function to list the raw fields used by the quantity config files
+def raw_fields(quantities):
+   fields = set()
+   for config in quantities:
+      fields.update(parse_quantity(config).raw)
+   return sorted(fields)
+
+# Small function to write a synthetic case of size (nx, ny) in the given folder
+#   Smooth random fields on a stretched Y grid, existing raw files are kept
+def make_case(folder, nx, ny, fields):
+   for sub in ("raw", "post", "figs"):
+      os.makedirs(opjoin(folder, sub), exist_ok=True)
+   yy = 0.5 - 0.5 * np.cos(np.linspace(0., np.pi, ny))
+   np.savetxt(opjoin(folder, "raw", "yp.dat"), np.column_stack((np.arange(ny), yy)))
+   xx = np.linspace(0., 1., nx)
+   rng = np.random.default_rng(0)
+   for field in fields:
+      file = opjoin(folder, "raw", field)
+      if os.path.isfile(file) and os.path.getsize(file) == nx * ny * 8:
+         continue
+      a, b, c = rng.uniform(1., 4., 3)
+      (np.sin(a * np.pi * yy)[:,np.newaxis] * np.cos(b * np.pi * xx)[np.newaxis,:] + c).tofile(file)
+   config = opjoin(folder, "case.dat")
+   with open(config, "w") as out:
+      out.write("#\n# Synthetic case for the benchmarks\n#\n")
+      out.write("\n".join([np.str(nx), np.str(ny), "7e-4", "1e8", "0.71", \
+                           opjoin(folder, "raw"), opjoin(folder, "post"), opjoin(folder, "figs")]) + "\n")
+   return config
+
+# Small function to time one stage, with the peak memory of the arrays if traced
+def stage(results, name, function, nbytes = 0):
+   if args.memory:
+      tracemalloc.reset_peak()
+   start = time.perf_counter()
+   function()
+   elapsed = time.perf_counter() - start
+   results[name] = {"time": elapsed}
+   if args.memory:
+      results[name]["peak_memory"] = tracemalloc.get_traced_memory()[1]
+   if nbytes:
+      results[name]["throughput"] = nbytes / elapsed
+   print("   " + name + " : " + "{:.3f}".format(elapsed) + " s" \
+         + ("" if not nbytes else ", " + "{:.1f}".format(nbytes / elapsed / 2**20) + " MiB/s") \
+         + ("" if not args.memory else ", peak " + "{:.1f}".format(results[name]["peak_memory"] / 2**20) + " MiB"))
+
+# Small function to time the start of a script in a new interpreter, averaged over the repeats
+#   The folder of this script is added to the path, to find module.py and plot.py
+def startup(results, name, command):
+   env = dict(os.environ)
+   env["PYTHONPATH"] = os.pathsep.join([here] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+   start = time.perf_counter()
+   for n in range(args.repeat):
+      subprocess.run([sys.executable] + command, env=env, stdout=subprocess.DEVNULL, check=True)
+   elapsed = (time.perf_counter() - start) / args.repeat
+   results[name] = {"time": elapsed}
+   print("   " + name + " : " + "{:.3f}".format(elapsed) + " s per run")
+
+# Define and read arguments for the script
+parser = argparse.ArgumentParser(description="Benchmark the processing of synthetic cases")
+parser.add_argument("-s", "--sizes", nargs='+', default=["129x129", "513x257"], help="Grid sizes nx x ny, for instance 2049x1025")
+parser.add_argument("-w", "--workdir", default="bench", help="Folder for the synthetic cases")
+parser.add_argument("-n", "--nworkers", type=int, help="Number of threads for the builds (default: number of cores)")
+parser.add_argument("-p", "--npoints", type=int, default=10000, help="Number of probe points")
+parser.add_argument("-m", "--memory", help="Trace the peak memory of the arrays (slower)", action="store_true")
+parser.add_argument("--prefetch", type=int, default=2, help="Look-ahead window of the background reads for the second cold build")
+parser.add_argument("-r", "--repeat", type=int, default=5, help="Number of runs for the startup times")
+parser.add_argument("-o", "--output", help="Save the results in the given JSON file")
+args = parser.parse_args()
+
+quantities = sorted(glob("qty_*.dat"))
+budgets = sorted(glob("bud_*.dat"))
+fields = raw_fields(quantities)
+if args.memory:
+   tracemalloc.start()
+results = {}
+# Startup times, without and with pyplot
+print("Startup")
+result = results["startup"] = {}
+startup(result, "import module", ["-c", "import module"])
+startup(result, "import module and pyplot", ["-c", "import module, matplotlib.pyplot"])
+for size in args.sizes:
+   nx, ny = [np.int(n) for n in size.split("x")]
+   print("Grid " + size + " : " + np.str(len(fields)) + " raw fields, " \
+         + np.str(len(quantities)) + " quantities, " + np.str(len(budgets)) + " budgets")
+   folder = os.path.abspath(opjoin(args.workdir, size))
+   config = make_case(folder, nx, ny, fields)
+   for file in glob(opjoin(folder, "post", "*.hdf")) + glob(opjoin(folder, "figs", "*.png")):
+      os.remove(file)
+   result = results[size] = {"nx": nx, "ny": ny}
+   rawbytes = len(fields) * nx * ny * 8
+   # Build everything from the raw fields, without and with the background reads
+   case = setup(config)
+   stage(result, "cold build", lambda: builder(case, quantities, budgets).run(args.nworkers), rawbytes)
+   for file in glob(opjoin(folder, "post", "*.hdf")):
+      os.remove(file)
+   case = setup(config, prefetch=args.prefetch)
+   stage(result, "cold build, prefetching", lambda: builder(case, quantities, budgets).run(args.nworkers), rawbytes)
+   result["cold build, prefetching"]["prefetched"] = case.cache.prefetched
+   # Same build with a cache holding a quarter of the raw fields, the background reads evict the fields already used
+   for file in glob(opjoin(folder, "post", "*.hdf")):
+      os.remove(file)
+   case = setup(config, cachesize=max(rawbytes // 4, (args.prefetch + 1) * nx * ny * 8), prefetch=args.prefetch)
+   stage(result, "cold build, prefetching, small cache", lambda: builder(case, quantities, budgets).run(args.nworkers), rawbytes)
+   result["cold build, prefetching, small cache"]["prefetched"] = case.cache.prefetched
+   print("      " + np.str(case.cache.prefetched) + " raw fields read in the background, " \
+         + np.str(case.cache.misses) + " misses, " + np.str(case.cache.evictions) + " evictions")
+   # Print values from the processed data in a new interpreter, as from a shell loop
+   if budgets:
+      startup(result, "plot.py --xyval", [opjoin(here, "plot.py"), "-c", config, "-b", budgets[0], "--xyval", "0.5", "0.5"])
+   # Load everything from the processed data
+   case = setup(config)
+   objects = {}
+   def warm():
+      for config_qty in quantities:
+         objects[config_qty] = quantity(case, config_qty)
+   stage(result, "warm load", warm, len(quantities) * nx * ny * 8)
+   # Profiles of all budgets from the processed data, without loading the 2D fields
+   case = setup(config, lazy=True)
+   buds = [budget(case, config_bud) for config_bud in budgets]
+   def profiles():
+      for bud in buds:
+         bud.extract(np.s_[nx//2,:])
+         bud.extract(np.s_[:,ny//2])
+   stage(result, "profile extraction", profiles)
+   # Probe all budgets at random locations
+   rng = np.random.default_rng(1)
+   x = rng.uniform(0., 1., args.npoints)
+   y = rng.uniform(0., 1., args.npoints)
+   def probes():
+      for bud in buds:
+         bud.xyprobe(x, y, "linear")
+   stage(result, "point probing", probes)
+   # Wall-averaged profiles and averages over the domain of all budgets, from the stacked arrays
+   def averages():
+      for bud in buds:
+         bud.line_average(0)
+         bud.mean()
+   stage(result, "averages", averages)
+   for bud in buds:
+      bud.release()
+   # Render one profile and one pie chart per budget
+   def figures():
+      for bud in buds:
+         for method, fig in (("xplot", bud.xplot(0.5)[0]), ("xypie", bud.xypie(0.5, 0.5)[0])):
+            fig.savefig(opjoin(case.figfolder, bud.config[:-4] + "_" + method + ".png"))
+            plt.close(fig)
+   stage(result, "figure rendering", figures)
+
+if args.output:
+   with open(args.output, "w") as out:
+      json.dump(results, out, indent=1)
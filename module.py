@@ -1,78 +1,1078 @@
 #! /usr/bin/env python3
 
+#
+# matplotlib.pyplot and h5py are imported on first use
+#   They are slow to import, and not needed to only extract values
+#
 import numpy as np
-import matplotlib.pyplot as plt
 from os.path import join as ospjoin
 from os.path import isfile as opisfile
-import h5py as hp
+from os import stat as osstat
+from os import replace as osreplace
+import hashlib
+import re
+from collections import OrderedDict, deque
+from itertools import combinations
+import threading
+import time
+import json
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+#
+# Small function to read a config file
+# Returns the list of lines, comment lines starting with '#' are skipped
+#
+# Parsed config files are kept until they are modified, see parse_config
+#
+def read_config(config):
+   tmp = []
+   for line in open(config,"r").read().splitlines():
+      if line.strip() and line[0] != "#":
+         tmp.append(line)
+   return tmp
+
+#
+# Small function to split a derivative item, for instance d/dy(uumean.dat) or d/dx(qty_u.dat)
+#   Derivatives can be nested, d/dx(d/dy(umean.dat))
+# Returns the axis (0 for x, 1 for y) and the differentiated item, or None if the item is not a derivative
+#
+derivative_item = re.compile(r"^d/d([xy])\((.+)\)$")
+def split_derivative(item):
+   match = derivative_item.match(item)
+   if match is None:
+      return None
+   return "xy".index(match.group(1)), match.group(2)
+
+#
+# Small function to get the raw field or the quantity below the derivatives of an item
+#
+def base_item(item):
+   derivative = split_derivative(item)
+   while derivative is not None:
+      item = derivative[1]
+      derivative = split_derivative(item)
+   return item
+
+#
+# Small function to parse and check the config file of a quantity or a budget
+#   kind : qtyconfig or budconfig
+# Returns the parsed config, which is kept until the file is modified
+# Raises ValueError if the config file is not valid
+#
+parsed_cache = {}
+def parse_config(config, kind):
+   mtime = osstat(config).st_mtime_ns
+   key = (kind.__name__, config)
+   if key in parsed_cache and parsed_cache[key][0] == mtime:
+      return parsed_cache[key][1]
+   parsed = kind(config)
+   parsed_cache[key] = (mtime, parsed)
+   return parsed
+def parse_quantity(config):
+   return parse_config(config, qtyconfig)
+def parse_budget(config):
+   return parse_config(config, budconfig)
+
+#
+# Create a class for the parsed config file of a quantity
+#   Mandatory fields
+#     name of the quantity (str)
+#     number of terms in this quantity (int)
+#     one term per line, items separated with one space, last item is the scaling factor
+#     scalar rescaling factor
+#   Optional fields
+#     linestyle (str)
+#     marker edge color (str)
+#     marker every (int)
+#
+class qtyconfig:
+   #
+   # Parse and check a config file
+   #
+   def __init__(self, config):
+      self.config = np.str(config)
+      tmp = read_config(self.config)
+      if len(tmp) < 3:
+         self.fail("name, number of terms and scaling factor are mandatory")
+      # Name of the quantity for legends
+      self.name = np.str(tmp[0])
+      # Number of terms in the quantity
+      try:
+         self.nterms = np.int(tmp[1])
+      except ValueError:
+         self.fail("the number of terms is not an integer : " + tmp[1])
+      if len(tmp) < np.abs(self.nterms) + 3:
+         self.fail("expected " + np.str(np.abs(self.nterms)) + " terms and a scaling factor")
+      # Terms : list of (items, scaling factor)
+      self.terms = []
+      for line in tmp[2:np.abs(self.nterms)+2]:
+         list_term = line.split()
+         self.terms.append((tuple(list_term[:-1]), list_term[-1]))
+      # Final scaling factor
+      self.scaling = tmp[self.nterms+2].strip()
+      # Check the scaling factors
+      for factor in [factor for list_items, factor in self.terms] + [self.scaling]:
+         try:
+            compile_scaling(factor)
+         except ValueError as err:
+            self.fail(np.str(err))
+      # Sub-quantities and raw fields, including the ones below the derivatives
+      items = set()
+      for list_items, factor in self.terms:
+         items.update(list_items)
+      self.derivatives = sorted(item for item in items if split_derivative(item) is not None)
+      items = set(base_item(item) for item in items)
+      self.children = sorted(item for item in items if item[:4] == "qty_")
+      self.raw = sorted(item for item in items if item[:4] != "qty_")
+      for item in self.raw:
+         if "(" in item or ")" in item:
+            self.fail("incorrect derivative " + item + ", expected d/dx(item) or d/dy(item)")
+      for child in self.children:
+         if not opisfile(child):
+            self.fail("missing sub-quantity " + child)
+      # Normalized text of the terms and scaling factor
+      self.text = [" ".join(line.split()) for line in tmp[1:self.nterms+3]]
+      # Optional parameters for 1D plots
+      if len(tmp) > self.nterms+3:
+         if len(tmp) < self.nterms+6:
+            self.fail("linestyle, marker edge color and marker every are expected together")
+         self.clr = np.str(tmp[self.nterms+3])
+         self.mrkedgeclr = np.str(tmp[self.nterms+4])
+         try:
+            self.markevery = np.int(tmp[self.nterms+5])
+         except ValueError:
+            self.fail("marker every is not an integer : " + tmp[self.nterms+5])
+      else:
+         self.clr = None
+         self.mrkedgeclr = 'none'
+         self.markevery = 'none'
+   
+   #
+   # Stop with a message about the config file
+   #
+   def fail(self, message):
+      raise ValueError("Incorrect quantity config file " + self.config + " : " + message)
+   
+   def __repr__(self):
+      return self.config
+
+#
+# Create a class for the parsed config file of a budget
+#   Mandatory fields
+#     name of the budget (str)
+#     the quantity file for each term
+#     "Y" or "N" to compute the error
+#
+class budconfig:
+   #
+   # Parse and check a config file
+   #
+   def __init__(self, config):
+      self.config = np.str(config)
+      tmp = read_config(self.config)
+      if len(tmp) < 3:
+         self.fail("name, at least one quantity and Y / N are mandatory")
+      # Name
+      self.name = np.str(tmp[0])
+      # List of the terms
+      self.qty_list = [line.strip() for line in tmp[1:-1]]
+      for qty in self.qty_list:
+         if not opisfile(qty):
+            self.fail("missing quantity " + qty)
+      # Compute the error ?
+      if tmp[-1].strip() not in ("Y", "y", "N", "n"):
+         self.fail("last line must be Y or N : " + tmp[-1])
+      self.error = tmp[-1].strip() in ("Y", "y")
+   
+   #
+   # Stop with a message about the config file
+   #
+   def fail(self, message):
+      raise ValueError("Incorrect budget config file " + self.config + " : " + message)
+   
+   def __repr__(self):
+      return self.config
+
+#
+# Small function to get the integration weights on a 1D grid (trapezoidal rule)
+# Returns an array w such that sum(w * f) is the integral of f
+#
+def trapezoid_weights(grid):
+   w = np.zeros(len(grid))
+   dx = np.diff(grid)
+   w[:-1] = w[:-1] + 0.5 * dx
+   w[1:] = w[1:] + 0.5 * dx
+   return w
+
+#
+# Small function to get the integration weights on a 1D grid (Simpson's rule)
+#   Pairs of intervals of a stretched grid, the last interval is corrected for an odd number of intervals
+# Returns an array w such that sum(w * f) is the integral of f
+#
+def simpson_weights(grid):
+   if len(grid) < 3:
+      return trapezoid_weights(grid)
+   w = np.zeros(len(grid))
+   dx = np.diff(grid)
+   npairs = len(dx) // 2
+   h0 = dx[0:2*npairs:2]
+   h1 = dx[1:2*npairs:2]
+   np.add.at(w, np.arange(0, 2*npairs, 2), (h0 + h1) / 6. * (2. - h1 / h0))
+   np.add.at(w, np.arange(1, 2*npairs, 2), (h0 + h1)**3 / (6. * h0 * h1))
+   np.add.at(w, np.arange(2, 2*npairs+1, 2), (h0 + h1) / 6. * (2. - h0 / h1))
+   if len(dx) % 2 == 1:
+      # Last interval, with the quadratic through the last three nodes
+      h0, h1 = dx[-2], dx[-1]
+      w[-1] = w[-1] + (2. * h1**2 + 3. * h0 * h1) / (6. * (h0 + h1))
+      w[-2] = w[-2] + (h1**2 + 3. * h0 * h1) / (6. * h0)
+      w[-3] = w[-3] - h1**3 / (6. * h0 * (h0 + h1))
+   return w
+
+#
+# Integration rules available for the setup of a case
+#
+quadrature_rules = {"trapezoid": trapezoid_weights, "simpson": simpson_weights}
 
 #
 # Small function to read one field
 # Returns a 2D array of size (nx, ny)
 #
 # If file starts with "qty_"
-#   Existing processed data is used if present
-#   Otherwise, the quantity constructor is used
+#   The quantity constructor is used
+#   It reads the processed data if present and up to date
 #
-# Otherwise, a binary file is read
+# Otherwise, the binary file is read through the raw cache of the case
+#   Derivative items, for instance d/dy(uumean.dat), are computed and cached the same way
 #
 def read_one(case, file):
    if file[:4]=="qty_":
-      if opisfile(ospjoin(case.postfolder, file[:-4] + ".hdf")):
-          h5f = hp.File(ospjoin(case.postfolder, file[:-4] + ".hdf"), 'r')
-          output = h5f[file[:-4]][:]
-          h5f.close()
-      else:
-         output = quantity(case, file).data
+      output = quantity(case, file).data
    else:
-      output = (np.fromfile(ospjoin(case.rawfolder, file)).reshape((case.ny, case.nx))).transpose()
+      output = case.cache.get(file)
+   return output
+
+#
+# Small function to get the key of a quantity
+# Returns a str, the hash of
+#   the parameters of the case (nx, ny, dt, Ra, Pr) and its data types
+#   the terms of the quantity, whitespace is normalized
+#   the size and modification time of each raw field
+#   the order of the finite differences and the size and modification time of the Y grid, with derivative items
+#   the key of each sub-quantity
+#
+def get_key(case, config):
+   parsed = parse_quantity(config)
+   lines = [" ".join(np.str(par) for par in (case.nx, case.ny, case.dt, case.ra, case.pr)), \
+            " ".join(np.dtype(par).str for par in (case.rawdtype, case.dtype, case.storedtype))]
+   lines.extend(parsed.text)
+   if parsed.derivatives:
+      # Derivatives also depend on the Y grid, the name of the file is hard-coded
+      lines.append("order " + np.str(case.order))
+      stat = osstat(ospjoin(case.rawfolder, "yp.dat"))
+      lines.append("yp.dat " + np.str(stat.st_size) + " " + np.str(stat.st_mtime_ns))
+   for item in parsed.children:
+      lines.append(item + " " + get_key(case, item))
+   for item in parsed.raw:
+      stat = osstat(ospjoin(case.rawfolder, item))
+      lines.append(item + " " + np.str(stat.st_size) + " " + np.str(stat.st_mtime_ns))
+   return hashlib.sha1("\n".join(lines).encode()).hexdigest()
+
+#
+# Small function to read the processed data of a quantity
+#   From the single store of the case if any, from <postfolder>/<config>.hdf otherwise
+#   Optional index to read only part of the data with a hyperslab selection
+#   Optional level of the level-of-detail pyramid, see quantity.lod
+# Returns a 2D array of size (nx, ny), or the selected part
+#   or None if the data is missing or if its key differs
+#
+def load_hdf(case, config, key, index = Ellipsis, level = 0):
+   import h5py as hp
+   name = config[:-4]
+   dset = name if level == 0 else name + "_lod" + np.str(level)
+   with span(case, config, "hdf read") as event:
+      if case.store is not None:
+         output = case.store.load(dset, key, index)
+      elif not opisfile(ospjoin(case.postfolder, name + ".hdf")):
+         output = None
+      else:
+         with hp.File(ospjoin(case.postfolder, name + ".hdf"), 'r') as h5f:
+            if dset not in h5f or h5f[dset].attrs.get("key") != key:
+               output = None
+            else:
+               output = np.asarray(h5f[dset][index], dtype=case.dtype)
+      event["bytes"] = 0 if output is None else output.nbytes
    return output
 
+#
+# Small function to save the processed data of a quantity with its key
+#   In the single store of the case if any, in <postfolder>/<config>.hdf otherwise
+#   Optional level of the level-of-detail pyramid, saved next to the data
+#
+def save_hdf(case, config, data, key, level = 0):
+   import h5py as hp
+   name = config[:-4]
+   dset = name if level == 0 else name + "_lod" + np.str(level)
+   with span(case, config, "hdf write") as event:
+      event["bytes"] = data.size * case.storedtype.itemsize
+      if case.store is not None:
+         return case.store.save(dset, data, key)
+      with hp.File(ospjoin(case.postfolder, name + ".hdf"), 'w' if level == 0 else 'a') as h5f:
+         if dset in h5f:
+            del h5f[dset]
+         h5f.create_dataset(dset, data=data, dtype=case.storedtype)
+         h5f[dset].attrs["key"] = key
+
+#
+# Small function to check if the processed data of a quantity is up to date, without reading it
+#
+def has_hdf(case, config, key):
+   return load_hdf(case, config, key, np.s_[:0]) is not None
+
+#
+# Small function to average blocks of 2 x 2 nodes, for the level-of-detail pyramid
+#   The last block is smaller when the size is odd
+# Returns an array of size (ceil(nx/2), ceil(ny/2)), or ceil(n/2) in 1D
+#
+def coarsen(data):
+   output = np.asarray(data)
+   for axis in range(output.ndim):
+      start = np.arange(0, output.shape[axis], 2)
+      count = np.minimum(2, output.shape[axis] - start)
+      shape = [1] * output.ndim
+      shape[axis] = len(start)
+      output = np.add.reduceat(output, start, axis=axis) / count.reshape(shape)
+   return output.astype(np.asarray(data).dtype, copy=False)
+
+#
+# Small function to time a step of the computations when the case is profiled
+#   with span(case, name, category) as event:
+#      event["bytes"] = number of bytes read or written
+#
+def span(case, name, category):
+   if case.profile is None:
+      return nullcontext({})
+   return case.profile.span(name, category)
+
+#
+# Create a class for the profiling of the computations
+#   Each step is an event with a name, a category, a duration and a number of bytes
+#   Events are nested, each thread has its own stack
+#   Each event counts the hits and misses of the raw cache in the step itself
+#   Optional tracing of the peak memory of the arrays with tracemalloc, it slows every allocation
+#
+class profiler:
+   #
+   # Initialize and optionally start tracing the memory
+   #
+   def __init__(self, memory = False):
+      self.events = []
+      self.lock = threading.Lock()
+      self.local = threading.local()
+      self.start = time.perf_counter()
+      self.memory = memory
+      if memory and not tracemalloc.is_tracing():
+         tracemalloc.start()
+   
+   #
+   # Time one step, nested inside the current step of the thread
+   #
+   @contextmanager
+   def span(self, name, category):
+      if not hasattr(self.local, "stack"):
+         self.local.stack = []
+      stack = self.current() + [category + ":" + name]
+      event = {"name": name, "cat": category, "bytes": 0, "hits": 0, "misses": 0, "child": 0., \
+               "stack": ";".join(stack), "tid": threading.get_ident()}
+      self.local.stack.append(event)
+      start = time.perf_counter()
+      try:
+         yield event
+      finally:
+         event["ts"] = start - self.start
+         event["dur"] = time.perf_counter() - start
+         self.local.stack.pop()
+         # Time spent in the nested steps of the parent
+         if self.local.stack:
+            self.local.stack[-1]["child"] += event["dur"]
+         with self.lock:
+            self.events.append(event)
+   
+   #
+   # Stack of the current step of the thread, a list of "category:name"
+   #   Includes the stack adopted from the thread that requested the work
+   #
+   def current(self):
+      stack = getattr(self.local, "stack", [])
+      return getattr(self.local, "root", []) + [parent["cat"] + ":" + parent["name"] for parent in stack]
+   
+   #
+   # Nest the steps of the thread under the stack of another thread
+   #   Used by the background reads, under the step that requested them
+   #
+   @contextmanager
+   def adopt(self, stack):
+      root = getattr(self.local, "root", [])
+      self.local.root = list(stack)
+      try:
+         yield
+      finally:
+         self.local.root = root
+   
+   #
+   # Count a hit or a miss of the raw cache in the current step of the thread
+   #
+   def count(self, counter):
+      stack = getattr(self.local, "stack", [])
+      if stack:
+         stack[-1][counter] = stack[-1][counter] + 1
+   
+   #
+   # Total time, self time (without nested steps), bytes and count per (name, category)
+   # Returns a list of dictionaries, sorted by decreasing self time
+   #
+   def summary(self):
+      nodes = OrderedDict()
+      for event in self.events:
+         node = nodes.setdefault((event["name"], event["cat"]), \
+                                 {"name": event["name"], "cat": event["cat"], "count": 0, "time": 0., "self": 0., "bytes": 0, \
+                                  "hits": 0, "misses": 0})
+         node["count"] = node["count"] + 1
+         node["time"] = node["time"] + event["dur"]
+         node["self"] = node["self"] + event["dur"] - event["child"]
+         node["bytes"] = node["bytes"] + event["bytes"]
+         node["hits"] = node["hits"] + event["hits"]
+         node["misses"] = node["misses"] + event["misses"]
+      return sorted(nodes.values(), key=lambda node: -node["self"])
+   
+   #
+   # Write the profile
+   #   ".folded" : one line per stack with its self time (us), for flame graphs
+   #   otherwise : JSON trace (chrome://tracing, Perfetto, speedscope) with the summary,
+   #               the counters of the raw cache and the peak memory if traced
+   #   Background reads are under the stack of the step that requested them
+   #
+   def dump(self, file, case = None):
+      if file.endswith(".folded"):
+         folded = OrderedDict()
+         for event in self.events:
+            folded[event["stack"]] = folded.get(event["stack"], 0.) + event["dur"] - event["child"]
+         with open(file, "w") as out:
+            for stack, dur in folded.items():
+               out.write(stack + " " + np.str(max(np.int(dur * 1e6), 0)) + "\n")
+         return
+      trace = [{"name": event["name"], "cat": event["cat"], "ph": "X", "pid": 0, "tid": event["tid"], \
+                "ts": event["ts"] * 1e6, "dur": event["dur"] * 1e6, "args": {"bytes": event["bytes"], "hits": event["hits"], "misses": event["misses"], "stack": event["stack"]}} \
+               for event in self.events]
+      other = {"summary": self.summary()}
+      if self.memory:
+         other["peak_memory"] = tracemalloc.get_traced_memory()[1]
+      if case is not None:
+         other["cache"] = {"hits": case.cache.hits, "misses": case.cache.misses, \
+                           "evictions": case.cache.evictions, "prefetched": case.cache.prefetched, "bytes": case.cache.nbytes, "mapped": case.cache.mapped}
+      with open(file, "w") as out:
+         json.dump({"traceEvents": trace, "displayTimeUnit": "ms", "otherData": other}, out, indent=1)
+   
+   #
+   # Add basic and detailed description
+   #
+   def __repr__(self):
+      return "profiler(" + np.str(len(self.events)) + " events)"
+   def __str__(self):
+      output = "Profile of the computations :" + "\n"
+      if self.memory:
+         output = output + "   Peak memory (bytes) : " + np.str(tracemalloc.get_traced_memory()[1]) + "\n"
+      output = output + "   name | category | count | total (s) | self (s) | bytes | hits | misses" + "\n"
+      for node in self.summary():
+         output = output + "   " + node["name"] + " | " + node["cat"] + " | " + np.str(node["count"]) + " | " \
+                  + "{:.4f}".format(node["time"]) + " | " + "{:.4f}".format(node["self"]) + " | " + np.str(node["bytes"]) + " | " \
+                  + np.str(node["hits"]) + " | " + np.str(node["misses"]) + "\n"
+      return output
+
+#
+# Small function to compute the finite difference weights of the first derivative on a grid
+#   Stencils of order+1 nodes, centered inside and one-sided near the boundaries
+#   Exact for polynomials of degree order, on uniform and stretched grids
+# Returns the indices and the weights of the stencils, two arrays of size (n, order+1)
+#
+def fd_weights(grid, order):
+   n = len(grid)
+   npts = order + 1
+   if n < npts:
+      raise ValueError("Finite differences of order " + np.str(order) + " need at least " + np.str(npts) + " nodes")
+   start = np.clip(np.arange(n) - order // 2, 0, n - npts)
+   index = start[:,np.newaxis] + np.arange(npts)
+   # Distances to the node, scaled by the width of the stencil
+   width = grid[index[:,-1]] - grid[index[:,0]]
+   dist = (grid[index] - grid[:,np.newaxis]) / width[:,np.newaxis]
+   # Moments of the weights : sum_k w_k dist_k**p = 1 for p = 1, 0 otherwise
+   vander = dist[:,np.newaxis,:] ** np.arange(npts)[np.newaxis,:,np.newaxis]
+   rhs = np.zeros((n, npts, 1))
+   rhs[:,1,0] = 1.
+   weights = np.linalg.solve(vander, rhs)[:,:,0] / width[:,np.newaxis]
+   return index, weights
+
+#
+# Small function to differentiate a field along x (axis 0) or y (axis 1)
+#   Stencils are computed once per case, see setup.fdweights
+# Returns a 2D array of size (nx, ny)
+#
+def derivative(case, data, axis):
+   index, weights = case.fdweights(axis)
+   shape = (-1, 1) if axis == 0 else (1, -1)
+   output = np.zeros(np.shape(data), case.dtype)
+   buf = np.empty(np.shape(data), case.dtype)
+   for k in range(index.shape[1]):
+      np.take(data, index[:,k], axis=axis, out=buf)
+      np.multiply(buf, weights[:,k].reshape(shape), out=buf)
+      np.add(output, buf, out=output)
+   return output
+
+#
+# Create a class for the cache of the raw fields
+#   Each binary file is read once per setup
+#   Least recently used fields are evicted above the memory budget (bytes)
+#   Fields can be memory-mapped instead of loaded in memory, they are not counted in the memory budget
+#
+# Cached fields are read-only, they must not be modified in place
+#
+class rawcache:
+   #
+   # Initialize with the setup of the case
+   #   Optional look-ahead window, the number of raw files read in the background but not used yet (0 : no prefetching)
+   #
+   def __init__(self, case, maxbytes = 2**31, mmap = False, prefetch = 0):
+      self.case = case
+      self.maxbytes = maxbytes
+      self.mmap = mmap
+      # Cached fields, from the least to the most recently used
+      #   Memory-mapped fields are counted apart, they are not held in memory and never evicted
+      self.fields = OrderedDict()
+      self.nbytes = 0
+      self.mapped = 0
+      # The cache is shared by the threads of a builder and by the background reads
+      self.lock = threading.RLock()
+      # Background reads : files being read, files read but not used yet and files waiting
+      #   Files being read are waited for by get, the threads are started on first use
+      self.depth = prefetch
+      self.pending = {}
+      self.ready = set()
+      self.waited = set()
+      self.queue = deque()
+      self.pool = None
+      # Stack of the step that requested each background read, when profiling
+      self.requester = {}
+      self.fieldbytes = case.nx * case.ny * np.dtype(case.dtype).itemsize
+      # Counters
+      self.hits = 0
+      self.misses = 0
+      self.evictions = 0
+      self.prefetched = 0
+   
+   #
+   # Get a raw field, read the binary file only if needed
+   #   A field being read in the background is waited for
+   # Returns a 2D array of size (nx, ny)
+   #
+   def get(self, file):
+      with self.lock:
+         # A field read in the background leaves the look-ahead window once used
+         if file in self.ready:
+            self.ready.discard(file)
+            self.submit()
+         if file in self.fields:
+            self.hits = self.hits + 1
+            if self.case.profile is not None:
+               self.case.profile.count("hits")
+            self.fields.move_to_end(file)
+            return self.fields[file]
+         self.misses = self.misses + 1
+         if self.case.profile is not None:
+            self.case.profile.count("misses")
+         future = self.pending.get(file)
+         if future is not None:
+            self.waited.add(file)
+         elif file in self.queue:
+            self.queue.remove(file)
+            self.requester.pop(file, None)
+      if future is not None:
+         return self.store(file, future.result())
+      return self.store(file, self.load(file))
+   
+   #
+   # Read raw fields in the background, in the order they will be used
+   #   At most depth files are read ahead of their use, the next ones wait in a queue
+   #   Fields already cached, being read or waiting are skipped
+   #   When profiling, a waiting file is requested again by the latest, most specific step
+   #
+   def prefetch(self, files):
+      if self.depth <= 0 or self.mmap:
+         return
+      with self.lock:
+         for file in files:
+            if file in self.fields or file in self.pending:
+               continue
+            if file not in self.queue:
+               self.queue.append(file)
+            if self.case.profile is not None:
+               self.requester[file] = self.case.profile.current()
+         self.submit()
+   
+   #
+   # Forget the background reads of files not needed anymore, for instance when a quantity is done
+   #   Fields already read stay cached but leave the look-ahead window, reads in progress complete
+   #
+   def cancel(self, files):
+      if self.depth <= 0:
+         return
+      with self.lock:
+         for file in files:
+            if file in self.queue:
+               self.queue.remove(file)
+               self.requester.pop(file, None)
+            self.ready.discard(file)
+         self.submit()
+   
+   #
+   # Start the reads waiting in the queue
+   #   Up to depth files read but not used yet, including the reads in progress
+   #   No read is started if the fields read but not used yet would not fit in the memory budget
+   #   The other cached fields are evicted when the fields read in the background are stored
+   #
+   def submit(self):
+      with self.lock:
+         if not self.queue:
+            return
+         if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.depth, thread_name_prefix="prefetch")
+         while self.queue and len(self.pending) + len(self.ready) < self.depth \
+               and (len(self.pending) + len(self.ready) + 1) * self.fieldbytes <= self.maxbytes:
+            file = self.queue.popleft()
+            self.pending[file] = self.pool.submit(self.background, file, self.requester.pop(file, None))
+            self.pending[file].add_done_callback(lambda future, file=file: self.done(file, future))
+   
+   #
+   # Read a field in the background, under the stack of the step that requested it
+   #
+   def background(self, file, stack):
+      if stack is None:
+         return self.load(file)
+      with self.case.profile.adopt(stack):
+         return self.load(file)
+   
+   #
+   # Keep a field read in the background, then start the next read
+   #   The field stays in the look-ahead window until used, unless get is already waiting for it
+   #   A failed read is raised again by get
+   #
+   def done(self, file, future):
+      with self.lock:
+         self.pending.pop(file, None)
+         if future.exception() is None:
+            self.store(file, future.result())
+            self.prefetched = self.prefetched + 1
+            if file not in self.waited and file in self.fields:
+               self.ready.add(file)
+         self.waited.discard(file)
+         self.submit()
+   
+   #
+   # Add one field to the cache
+   #   Evict the least recently used fields held in memory, keep at least the last one
+   #
+   def store(self, key, output):
+      with self.lock:
+         if key in self.fields:
+            return self.fields[key]
+         self.fields[key] = output
+         if isinstance(output, np.memmap):
+            self.mapped = self.mapped + output.nbytes
+            return output
+         self.nbytes = self.nbytes + output.nbytes
+         if self.nbytes > self.maxbytes:
+            # Least recently used first, the fields read in the background but not used yet last
+            olds = [old for old in self.fields if old != key and not isinstance(self.fields[old], np.memmap)]
+            for old in [old for old in olds if old not in self.ready] + [old for old in olds if old in self.ready]:
+               if self.nbytes <= self.maxbytes:
+                  break
+               self.nbytes = self.nbytes - self.fields.pop(old).nbytes
+               self.evictions = self.evictions + 1
+               self.ready.discard(old)
+      return output
+   
+   #
+   # Read or memory-map one binary file
+   #   Memory-mapping is lost when the raw and compute data types differ
+   #   Derivative items are computed from the differentiated item, see derivative
+   #
+   def load(self, file):
+      split = split_derivative(file)
+      if split is not None:
+         with span(self.case, file, "derivative") as event:
+            output = derivative(self.case, read_one(self.case, split[1]), split[0])
+            event["bytes"] = output.nbytes
+         output.flags.writeable = False
+         return output
+      with span(self.case, file, "raw read") as event:
+         if self.mmap:
+            output = np.memmap(ospjoin(self.case.rawfolder, file), dtype=self.case.rawdtype, mode='r', shape=(self.case.ny, self.case.nx))
+         else:
+            output = np.fromfile(ospjoin(self.case.rawfolder, file), dtype=self.case.rawdtype).reshape((self.case.ny, self.case.nx))
+         event["bytes"] = output.nbytes
+         # Convert to the data type used for the computations
+         if output.dtype != self.case.dtype:
+            output = output.astype(self.case.dtype)
+      output.flags.writeable = False
+      return output.transpose()
+   
+   #
+   # Empty the cache, counters are kept
+   #
+   def clear(self):
+      with self.lock:
+         self.fields.clear()
+         self.nbytes = 0
+         self.mapped = 0
+         self.ready.clear()
+   
+   #
+   # Add basic and detailed description
+   #
+   def __repr__(self):
+      return "rawcache(" + np.str(len(self.fields)) + " fields)"
+   def __str__(self):
+      return "Cache of the raw fields :" + "\n" \
+             "   Fields / Bytes in memory / Bytes memory-mapped : " + np.str(len(self.fields)) + " / " + np.str(self.nbytes) + " / " + np.str(self.mapped) + "\n" \
+             "   Memory budget (bytes) : " + np.str(self.maxbytes) + "\n" \
+             "   Memory-mapped : " + np.str(self.mmap) + "\n" \
+             "   Background reads (look-ahead window) : " + np.str(self.depth) + "\n" \
+             "   Hits / Misses / Evictions / Prefetched : " + np.str(self.hits) + " / " + np.str(self.misses) + " / " + np.str(self.evictions) + " / " + np.str(self.prefetched) + "\n"
+
+#
+# Create a class for the products of raw fields shared by several quantities
+#   The terms of the quantities to compute are split together, see split_terms
+#   Each product used by several terms is computed once, it is kept until the last quantity using it is done
+#   Products are read-only and are not counted in the memory budget of the raw cache
+#
+class productcache:
+   #
+   # Initialize with the setup of the case
+   #
+   def __init__(self, case):
+      self.case = case
+      # Split terms of each quantity to compute, and number of quantities using each product
+      self.splits = {}
+      self.refs = {}
+      # Products computed, one lock per product being computed
+      self.products = {}
+      self.locks = {}
+      self.nbytes = 0
+      self.lock = threading.Lock()
+      # Counters
+      self.computed = 0
+      self.reused = 0
+   
+   #
+   # Register the quantities to compute, before any of them is computed
+   #   Quantities already registered or up to date are skipped
+   #
+   def register(self, configs):
+      with self.lock:
+         configs = [config for config in configs if config not in self.splits]
+      configs = [config for config in configs if not has_hdf(self.case, config, get_key(self.case, config))]
+      splits, uses = split_terms([merge_terms(self.case, parse_quantity(config).terms) for config in configs])
+      with self.lock:
+         for config, split in zip(configs, splits):
+            self.splits[config] = split
+            for sub in set(sub for shared, raw, qty, factor in split for sub in shared):
+               self.refs[sub] = self.refs.get(sub, 0) + 1
+   
+   #
+   # Split terms of a registered quantity, None otherwise
+   #
+   def split(self, config):
+      with self.lock:
+         return self.splits.get(config)
+   
+   #
+   # Get a product, compute it only if needed
+   #   The product is computed by one thread, the others wait for it
+   # Returns a 2D array of size (nx, ny)
+   #
+   def get(self, sub):
+      with self.lock:
+         if sub in self.products:
+            self.reused = self.reused + 1
+            return self.products[sub]
+         lock = self.locks.setdefault(sub, threading.Lock())
+      with lock:
+         with self.lock:
+            if sub in self.products:
+               self.reused = self.reused + 1
+               return self.products[sub]
+         output = np.multiply(read_one(self.case, sub[0]), read_one(self.case, sub[1]))
+         for item in sub[2:]:
+            np.multiply(output, read_one(self.case, item), out=output)
+         output.flags.writeable = False
+         with self.lock:
+            self.computed = self.computed + 1
+            self.locks.pop(sub, None)
+            if sub in self.refs:
+               self.products[sub] = output
+               self.nbytes = self.nbytes + output.nbytes
+      return output
+   
+   #
+   # Release the products used by a quantity, a product is dropped after its last user
+   #
+   def release(self, config):
+      with self.lock:
+         split = self.splits.pop(config, None)
+         if split is None:
+            return
+         for sub in set(sub for shared, raw, qty, factor in split for sub in shared):
+            self.refs[sub] = self.refs[sub] - 1
+            if self.refs[sub] == 0:
+               del self.refs[sub]
+               output = self.products.pop(sub, None)
+               if output is not None:
+                  self.nbytes = self.nbytes - output.nbytes
+   
+   #
+   # Add basic and detailed description
+   #
+   def __repr__(self):
+      return "productcache(" + np.str(len(self.products)) + " products)"
+   def __str__(self):
+      return "Cache of the shared products :" + "\n" \
+             "   Products / Bytes in memory : " + np.str(len(self.products)) + " / " + np.str(self.nbytes) + "\n" \
+             "   Quantities registered / Products referenced : " + np.str(len(self.splits)) + " / " + np.str(len(self.refs)) + "\n" \
+             "   Computed / Reused : " + np.str(self.computed) + " / " + np.str(self.reused) + "\n"
+
+#
+# Named parameters allowed in the scaling factors, case-insensitive
+#
+scaling_names = {
+   "pr": lambda case: case.pr,
+   "ra": lambda case: case.ra,
+   "dt": lambda case: case.dt,
+   "sqrtra": lambda case: np.sqrt(case.ra),
+   "re": lambda case: np.sqrt(case.ra) / case.pr,
+   "rapr": lambda case: case.ra * case.pr,
+   "prra": lambda case: case.ra * case.pr,
+   "invdt": lambda case: 1./case.dt,
+   "invdt2": lambda case: 1./case.dt**2,
+   "invre": lambda case: case.pr / np.sqrt(case.ra),
+   "invsqrtra": lambda case: 1./np.sqrt(case.ra),
+   "epsut": lambda case: (case.pr+1.)/np.sqrt(case.ra),
+}
+
+#
+# Functions allowed in the scaling factors
+#
+scaling_functions = {
+   "sqrt": np.sqrt,
+   "exp": np.exp,
+   "log": np.log,
+   "abs": np.abs,
+}
+
+#
+# Small function to compile a scaling factor, for instance 1., -invdt, Pr/sqrt(Ra) or -2*invdt
+#   Grammar : numbers, named parameters, functions, unary + -, binary + - * /, ** and parentheses
+# Returns the operations in postfix order, which are kept for the next calls
+# Raises ValueError if the scaling factor is not valid
+#
+scaling_cache = {}
+scaling_tokens = re.compile(r"\s*(?:(\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)|([A-Za-z_]\w*)|(\*\*|[-+*/()]))")
+def compile_scaling(term):
+   if term in scaling_cache:
+      return scaling_cache[term]
+   # Split into tokens
+   tokens = []
+   pos = 0
+   text = term.strip()
+   while pos < len(text):
+      match = scaling_tokens.match(text, pos)
+      if match is None or match.end() == pos:
+         raise ValueError("Unexpected character in the scaling factor " + term + " : " + text[pos:])
+      number, name, op = match.groups()
+      if number is not None:
+         tokens.append(("num", np.float(number)))
+      elif name is not None:
+         tokens.append(("name", name.lower()))
+      else:
+         tokens.append(("op", op))
+      pos = match.end()
+   tokens.append(("end", None))
+   # Recursive descent parser
+   ops = []
+   pos = [0]
+   def peek():
+      return tokens[pos[0]]
+   def take(expected = None):
+      token = tokens[pos[0]]
+      if expected is not None and token != ("op", expected):
+         raise ValueError("Expected '" + expected + "' in the scaling factor " + term)
+      pos[0] += 1
+      return token
+   def expr():
+      term_()
+      while peek() in (("op", "+"), ("op", "-")):
+         op = take()[1]
+         term_()
+         ops.append(("bin", op))
+   def term_():
+      unary()
+      while peek() in (("op", "*"), ("op", "/")):
+         op = take()[1]
+         unary()
+         ops.append(("bin", op))
+   def unary():
+      if peek() in (("op", "+"), ("op", "-")):
+         op = take()[1]
+         unary()
+         if op == "-":
+            ops.append(("neg", None))
+      else:
+         power()
+   def power():
+      atom()
+      if peek() == ("op", "**"):
+         take()
+         unary()
+         ops.append(("bin", "**"))
+   def atom():
+      kind, value = take()
+      if kind == "num":
+         ops.append(("num", value))
+      elif kind == "name" and peek() == ("op", "("):
+         if value not in scaling_functions:
+            raise ValueError("Unknown function in the scaling factor " + term + " : " + value)
+         take("(")
+         expr()
+         take(")")
+         ops.append(("call", value))
+      elif kind == "name":
+         if value not in scaling_names:
+            raise ValueError("Unknown parameter in the scaling factor " + term + " : " + value)
+         ops.append(("name", value))
+      elif (kind, value) == ("op", "("):
+         expr()
+         take(")")
+      else:
+         raise ValueError("Incorrect scaling factor " + term)
+   expr()
+   if peek()[0] != "end":
+      raise ValueError("Incorrect scaling factor " + term)
+   scaling_cache[term] = ops
+   return ops
+
+#
+# Small function to evaluate compiled operations with the parameters of a case
+#   names : dictionary of the named parameters
+# Returns a float
+#
+def eval_scaling(ops, names):
+   stack = []
+   for kind, value in ops:
+      if kind == "num":
+         stack.append(value)
+      elif kind == "name":
+         stack.append(names[value])
+      elif kind == "neg":
+         stack.append(-stack.pop())
+      elif kind == "call":
+         stack.append(scaling_functions[value](stack.pop()))
+      else:
+         right = stack.pop()
+         left = stack.pop()
+         if value == "+":
+            stack.append(left + right)
+         elif value == "-":
+            stack.append(left - right)
+         elif value == "*":
+            stack.append(left * right)
+         elif value == "/":
+            stack.append(left / right)
+         else:
+            stack.append(left ** right)
+   return np.float(stack[0])
+
 #
 # Small function to extract the scaling parameter
+#   Evaluated once per case, see setup.scaling
 # Returns a float
 #
 def get_scaling(case, term):
-   # Try to read a float
-   try:
-      scaling = np.float(term)
-      return scaling
-   except ValueError:
-      if term=="pr" or term=="Pr" or term=="PR":
-         return case.pr
-      elif term=="ra" or term=="Ra" or term=="RA":
-         return case.ra
-      elif term=="sqrtra" or term=="sqrtRa" or term=="sqrtRA":
-         return np.sqrt(case.ra)
-      if term=="re" or term=="Re" or term=="RE":
-         return np.sqrt(case.ra) / case.pr
-      elif term=="rapr" or term=="RaPr" or term=="RAPR" or term=="prra" or term=="PrRa" or term=="PRRA":
-         return case.ra * case.pr
-      if term=="dt" or term=="Dt" or term=="DT":
-         return case.dt
-      if term=="invdt" or term=="invDt" or term=="invDT":
-         return 1./case.dt
-      if term=="-invdt" or term=="-invDt" or term=="-invDT":
-         return - 1./case.dt
-      if term=="invdt2" or term=="invDt2" or term=="invDT2":
-         return 1./case.dt**2
-      if term=="-invdt2" or term=="-invDt2" or term=="-invDT2":
-         return -1./case.dt**2
-      if term=="invre" or term=="invRe" or term=="invRE":
-         return case.pr / np.sqrt(case.ra)
-      if term=="-invre" or term=="-invRe" or term=="-invRE":
-         return - case.pr / np.sqrt(case.ra)
-      elif term=="invsqrtra" or term=="invsqrtRa" or term=="invsqrtRA":
-         return 1./np.sqrt(case.ra)
-      elif term=="-invsqrtra" or term=="-invsqrtRa" or term=="-invsqrtRA":
-         return - 1./np.sqrt(case.ra)
-      elif term=="epsut":
-         return (case.pr+1.)/np.sqrt(case.ra)
-      elif term=="-epsut":
-         return -(case.pr+1.)/np.sqrt(case.ra)
-      else:
-         print("Error when reading the scaling factor")
-         return 1.
+   return case.scaling(term)
+
+#
+# Create a class for the single store of the processed data of a case
+#   One HDF5 file holds every quantity as its own dataset
+#   The file is opened once and kept open
+#   Datasets are chunked and optionally compressed ("gzip" or "lzf")
+#
+class hdfstore:
+   #
+   # Initialize with the setup of the case and the name of the file in the post-processed folder
+   #
+   def __init__(self, case, file, compression = None):
+      import h5py as hp
+      self.case = case
+      self.file = ospjoin(case.postfolder, file)
+      self.compression = compression
+      self.h5f = hp.File(self.file, 'a')
+   
+   #
+   # Get the dataset of a quantity without reading it
+   # Returns None if the quantity is missing
+   #
+   def dataset(self, name):
+      if name in self.h5f:
+         return self.h5f[name]
+      return None
+   
+   #
+   # Read the data of a quantity
+   #   Optional index to read only part of the data with a hyperslab selection
+   # Returns a 2D array of size (nx, ny), or the selected part
+   #   or None if the data is missing or if its key differs
+   #
+   def load(self, name, key, index = Ellipsis):
+      dset = self.dataset(name)
+      if dset is None or dset.attrs.get("key") != key:
+         return None
+      return np.asarray(dset[index], dtype=self.case.dtype)
+   
+   #
+   # Save the data of a quantity with its key
+   #
+   def save(self, name, data, key):
+      if name in self.h5f:
+         del self.h5f[name]
+      dset = self.h5f.create_dataset(name, data=data, dtype=self.case.storedtype, chunks=True, compression=self.compression)
+      dset.attrs["key"] = key
+      self.h5f.flush()
+   
+   #
+   # Close the file
+   #
+   def close(self):
+      if self.h5f:
+         self.h5f.close()
+   
+   #
+   # Add basic and detailed description
+   #
+   def __repr__(self):
+      return self.file
+   def __str__(self):
+      return "Store of the processed data :" + "\n" \
+             "   File : " + self.file + "\n" \
+             "   Compression : " + np.str(self.compression) + "\n" \
+             "   Number of quantities : " + np.str(len(self.h5f) if self.h5f else 0) + "\n"
 
 #
 # Create a class for the setup of the case
@@ -80,8 +1080,19 @@ def get_scaling(case, term):
 class setup:
    #
    # Initialize with a config file
+   #   Optional memory budget (bytes) and memory-mapping for the raw cache
+   #   Optional single store for the processed data (file name) and its compression
+   #   Optional lazy mode for the quantities and budgets of the case
+   #   Data types of the raw files, of the computations and of the processed data (default: dtype)
+   #   Optional compensated summation (Kahan) of the terms of the quantities and budgets
+   #   Order of the finite differences for the derivative items, 2 or 4
+   #   Integration rule, "trapezoid" or "simpson"
+   #   Number of raw files read in the background ahead of the computations (0 : no prefetching)
+   #   Optional profiling of the computations, and optional tracing of the peak memory in the profile
    #
-   def __init__(self, config):
+   def __init__(self, config, cachesize = 2**31, mmap = False, store = None, compression = None, lazy = False, \
+                rawdtype = np.float64, dtype = np.float64, storedtype = None, compensated = False, order = 2, \
+                quadrature = "trapezoid", prefetch = 0, profile = False, memory = False):
       self.config = np.str(config)
       #
       # Read the config file
@@ -108,9 +1119,167 @@ class setup:
       # Here, RK3 final time step is hard-coded
       self.dt = (4./12.) * self.dt # 3./4. - 5./12.
       # Here, the size of the domain in X is hard-coded
-      self.xx = np.linspace(0., 1., nx)
+      self.xx = np.linspace(0., 1., self.nx)
       # Read the Y grid, the name of the file is hard-coded
       self.yy = np.loadtxt(ospjoin(self.rawfolder, "yp.dat"), dtype=float)[:,1]
+      # Mid-points of the sorted Y grid, used to locate the nearest node
+      self.ymid = 0.5 * (self.yy[1:] + self.yy[:-1])
+      # Integration weights on the X and Y grids, and in the boxes already used
+      if quadrature not in quadrature_rules:
+         raise ValueError("Integration rule must be one of " + ", ".join(quadrature_rules) + " : " + np.str(quadrature))
+      self.quadrature = quadrature
+      self.wx = quadrature_rules[quadrature](self.xx)
+      self.wy = quadrature_rules[quadrature](self.yy)
+      self.boxes = {}
+      # Coordinates of the levels of the pyramid for 2D plots, built on first use
+      self.grids = {}
+      # Named parameters of the scaling factors, and the scaling factors already evaluated
+      self.names = {name: value(self) for name, value in scaling_names.items()}
+      self.scalings = {}
+      # Options to build the same setup in other processes, without the single store
+      self.options = dict(cachesize=cachesize, mmap=mmap, lazy=lazy, rawdtype=rawdtype, dtype=dtype, \
+                          storedtype=storedtype, compensated=compensated, order=order, quadrature=quadrature, \
+                          prefetch=prefetch)
+      # Profiling of the computations
+      #   Tracing the memory slows every allocation, it is only started on request
+      self.profile = profiler(memory) if profile else None
+      # Data types and summation
+      self.rawdtype = np.dtype(rawdtype)
+      self.dtype = np.dtype(dtype)
+      self.storedtype = np.dtype(storedtype if storedtype else dtype)
+      self.compensated = compensated
+      # Finite differences, the stencils along x and y are computed on first use
+      if order not in (2, 4):
+         raise ValueError("Order of the finite differences must be 2 or 4 : " + np.str(order))
+      self.order = order
+      self.stencils = {}
+      # Cache for the raw fields
+      self.cache = rawcache(self, cachesize, mmap, prefetch)
+      # Products of raw fields shared by the quantities of a builder
+      self.products = productcache(self)
+      # Quantities and budgets are loaded on first access in lazy mode
+      self.lazy = lazy
+      # Single store for the processed data, one file per quantity otherwise
+      if store:
+         self.store = hdfstore(self, store, compression)
+      else:
+         self.store = None
+   
+   #
+   # Level of the pyramid for a target resolution, the number of nodes along the longest direction
+   #   None for the full grid
+   #
+   def level(self, resolution = None):
+      if resolution is None:
+         return 0
+      return max(0, np.int(np.floor(np.log2(max(self.nx, self.ny) / resolution))))
+   
+   #
+   # Coordinates of the nodes of a level of the pyramid, see quantity.lod
+   #   The meshgrid of each level is built once and shared by the 2D plots
+   # Returns two 2D arrays of size (ny, nx) at level 0, about twice smaller per level
+   #
+   def meshgrid(self, level = 0):
+      if level not in self.grids:
+         xx, yy = self.xx, self.yy
+         for n in range(level):
+            xx, yy = coarsen(xx), coarsen(yy)
+         self.grids[level] = np.meshgrid(xx, yy)
+      return self.grids[level]
+   
+   #
+   # Integration weights in the box [x0, x1] x [y0, y1]
+   #   The rule of the case is applied to the nodes inside the box, weights are zero outside
+   #   Computed once per box
+   # Returns two arrays of size nx and ny, or None if the box has less than two nodes in a direction
+   #
+   def box_weights(self, x0 = 0., x1 = 1., y0 = 0., y1 = 1.):
+      box = (x0, x1, y0, y1)
+      if box not in self.boxes:
+         weights = []
+         for grid, lo, hi in ((self.xx, x0, x1), (self.yy, y0, y1)):
+            inside = (grid >= lo) & (grid <= hi)
+            if np.count_nonzero(inside) < 2:
+               print("Empty region for the integration weights : " + np.str(box))
+               return None
+            w = np.zeros(len(grid))
+            w[inside] = quadrature_rules[self.quadrature](grid[inside])
+            weights.append(w)
+         self.boxes[box] = weights
+      return self.boxes[box]
+   
+   #
+   # Finite difference stencils of the first derivative along x (axis 0) or y (axis 1)
+   #   Computed once from the grid, uniform in X and stretched in Y
+   # Returns the indices and the weights, two arrays of size (nx or ny, order+1)
+   #
+   def fdweights(self, axis):
+      if axis not in self.stencils:
+         self.stencils[axis] = fd_weights(self.xx if axis == 0 else self.yy, self.order)
+      return self.stencils[axis]
+   
+   #
+   # Value of a scaling factor for this case, evaluated once
+   # Raises ValueError if the scaling factor is not valid
+   #
+   def scaling(self, term):
+      if term not in self.scalings:
+         self.scalings[term] = eval_scaling(compile_scaling(term), self.names)
+      return self.scalings[term]
+   
+   #
+   # Locate the nearest node i of given location(s) x
+   #   Closed form on the uniform X grid
+   #   In case of a tie, the lowest index is returned
+   #
+   def locate_x(self, x):
+      i = np.ceil(np.asarray(x) * (self.nx - 1) - 0.5).astype(int)
+      return np.clip(i, 0, self.nx - 1)
+   
+   #
+   # Locate the nearest node j of given location(s) y
+   #   Binary search on the mid-points of the stretched Y grid
+   #   In case of a tie, the lowest index is returned
+   #
+   def locate_y(self, y):
+      return np.searchsorted(self.ymid, y, side='left')
+   
+   #
+   # Locate the nearest node (i, j) of given location(s) (x, y)
+   # Returns two integers, or two arrays of integers
+   #
+   def locate(self, x, y):
+      return self.locate_x(x), self.locate_y(y)
+   
+   #
+   # Nodes and weights used to probe given locations (x, y)
+   #   method : "nearest" node or "linear" (bilinear interpolation on the stretched grid)
+   #   Locations outside the domain get NaN weights
+   # Returns the indices i, j and the weights, arrays of size (nnodes, npoints)
+   #
+   def stencil(self, x, y, method = "nearest"):
+      x = np.atleast_1d(np.asarray(x, dtype=float))
+      y = np.atleast_1d(np.asarray(y, dtype=float))
+      outside = (x < 0.) | (x > 1.) | (y < 0.) | (y > 1.)
+      if method == "nearest":
+         i, j = self.locate(x, y)
+         i = i[np.newaxis,:]
+         j = j[np.newaxis,:]
+         w = np.ones(i.shape)
+      elif method == "linear":
+         # Lower-left node of the cell and relative position inside the cell
+         i0 = np.clip(np.floor(x * (self.nx - 1)).astype(int), 0, self.nx - 2)
+         j0 = np.clip(np.searchsorted(self.yy, y, side='right') - 1, 0, self.ny - 2)
+         tx = x * (self.nx - 1) - i0
+         ty = (y - self.yy[j0]) / (self.yy[j0+1] - self.yy[j0])
+         i = np.array([i0, i0+1, i0, i0+1])
+         j = np.array([j0, j0, j0+1, j0+1])
+         w = np.array([(1.-tx)*(1.-ty), tx*(1.-ty), (1.-tx)*ty, tx*ty])
+      else:
+         print("Incorrect method in stencil : " + np.str(method))
+         return None
+      w[:,outside] = np.nan
+      return i, j, w
    
    #
    # Add basic and detailed description
@@ -124,9 +1293,182 @@ class setup:
              "   Time step : " + np.str(self.dt) + "\n" \
              "   Rayleigh number : " + np.str(self.ra) + "\n" \
              "   Prandtl number : " + np.str(self.pr) + "\n" \
+             "   Data types (raw / compute / storage) : " + np.str(self.rawdtype) + " / " + np.str(self.dtype) + " / " + np.str(self.storedtype) + "\n" \
+             "   Order of the finite differences : " + np.str(self.order) + "\n" \
+             "   Integration rule : " + self.quadrature + "\n" \
              "   Raw data folder : " + self.rawfolder + "\n" \
              "   Post-processed data folder : " + self.postfolder + "\n" \
-             "   Figures folder : " + self.figfolder + "\n"
+             "   Figures folder : " + self.figfolder + "\n" \
+             "   Single store : " + repr(self.store) + "\n"
+
+#
+# Create a class for the sum of arrays in place
+#   With compensated summation (Kahan), the rounding errors are tracked and corrected
+#
+class accumulator:
+   #
+   # Initialize with the shape and data type of the sum
+   #
+   def __init__(self, shape, dtype, compensated = False):
+      self.data = np.zeros(shape, dtype)
+      self.compensated = compensated
+      if compensated:
+         self.comp = np.zeros(shape, dtype)
+         self.y = np.empty(shape, dtype)
+         self.t = np.empty(shape, dtype)
+   
+   #
+   # Add an array or a scalar
+   #
+   def add(self, x):
+      if not self.compensated:
+         np.add(self.data, x, out=self.data)
+         return
+      # y = x - comp, t = data + y, comp = (t - data) - y, data = t
+      np.subtract(x, self.comp, out=self.y)
+      np.add(self.data, self.y, out=self.t)
+      np.subtract(self.t, self.data, out=self.comp)
+      np.subtract(self.comp, self.y, out=self.comp)
+      np.copyto(self.data, self.t)
+
+#
+# Small function to merge the terms of a quantity with the same items
+#   terms : list of (items, scaling factor)
+# Returns the list of (sorted items, sum of the scaling factors)
+#
+def merge_terms(case, terms):
+   factors = OrderedDict()
+   for items, factor in terms:
+      key = tuple(sorted(items))
+      factors[key] = factors.get(key, 0.) + get_scaling(case, factor)
+   return list(factors.items())
+
+#
+# Small function to split the merged terms of several quantities into products of raw fields,
+#   other raw fields and sub-quantities
+#   The largest product of raw fields used by several terms is factored out first
+# Returns the split terms (products, raw fields, sub-quantities, factor) of each quantity,
+#   and the number of terms using each product, only the products used by several terms are kept
+#
+def split_terms(terms):
+   # Number of terms using each product of at least two raw fields
+   counts = {}
+   for quantity_terms in terms:
+      for items, factor in quantity_terms:
+         raw = tuple(item for item in items if item[:4] != "qty_")
+         for sub in set(sub for n in range(2, len(raw)+1) for sub in combinations(raw, n)):
+            counts[sub] = counts.get(sub, 0) + 1
+   splits = []
+   for quantity_terms in terms:
+      split = []
+      for items, factor in quantity_terms:
+         raw = [item for item in items if item[:4] != "qty_"]
+         shared = []
+         while len(raw) > 1:
+            candidates = sorted(set(sub for n in range(2, len(raw)+1) for sub in combinations(raw, n) if counts[sub] > 1))
+            if not candidates:
+               break
+            sub = max(candidates, key=lambda sub: (len(sub), counts[sub]))
+            shared.append(sub)
+            for item in sub:
+               raw.remove(item)
+         split.append((shared, raw, [item for item in items if item[:4] == "qty_"], factor))
+      splits.append(split)
+   # Number of uses of the products, a product used by one term only is computed in the buffer of the term
+   uses = {}
+   for split in splits:
+      for shared, raw, qty, factor in split:
+         for sub in shared:
+            uses[sub] = uses.get(sub, 0) + 1
+   output = []
+   for split in splits:
+      output.append([([sub for sub in shared if uses[sub] > 1], \
+                      [item for sub in shared if uses[sub] == 1 for item in sub] + raw, qty, factor) \
+                     for shared, raw, qty, factor in split])
+   return output, dict((sub, count) for sub, count in uses.items() if count > 1)
+
+#
+# Create a class for the evaluation plan of a quantity
+#   Each term is a product of items times a scaling factor
+#   Terms with the same items are merged
+#   Products of raw fields shared by several terms are computed once, the other products in a buffer
+#     Quantities registered by a builder share their products, see productcache
+#   Terms are accumulated in place inside preallocated buffers
+#
+class plan:
+   #
+   # Compile the terms (list of (items, scaling factor)) and the final scaling factor (str)
+   #   config : config file of the quantity, to use the products shared with the other quantities
+   #
+   def __init__(self, case, terms, scaling, config = None):
+      self.case = case
+      self.terms = merge_terms(case, terms)
+      self.scaling = get_scaling(case, scaling)
+      # Raw fields in the order they are used, derivatives need the field below them
+      self.raw = []
+      for items, factor in self.terms:
+         for item in sorted(base_item(item) for item in items):
+            if item[:4] != "qty_" and item not in self.raw:
+               self.raw.append(item)
+      # Terms split with the other quantities of a builder, or with the terms of this quantity only
+      self.split = case.products.split(config)
+      self.uses = {}
+      if self.split is None:
+         splits, self.uses = split_terms([self.terms])
+         self.split = splits[0]
+   
+   #
+   # Get a product shared by several terms, computed on first use
+   #   The products of this quantity only are released after their last use
+   #
+   def shared(self, sub, products, remaining):
+      if sub not in remaining:
+         return self.case.products.get(sub)
+      if sub not in products:
+         output = np.multiply(read_one(self.case, sub[0]), read_one(self.case, sub[1]))
+         for item in sub[2:]:
+            np.multiply(output, read_one(self.case, item), out=output)
+         products[sub] = output
+      output = products[sub]
+      remaining[sub] = remaining[sub] - 1
+      if remaining[sub] == 0:
+         del products[sub]
+      return output
+   
+   #
+   # Evaluate the quantity
+   # Returns a 2D array of size (nx, ny)
+   #
+   def run(self):
+      # Read the raw fields in the background, ahead of the arithmetic
+      self.case.cache.prefetch(self.raw)
+      total = accumulator((self.case.nx, self.case.ny), self.case.dtype, self.case.compensated)
+      buf = np.empty((self.case.nx, self.case.ny), self.case.dtype)
+      products = {}
+      remaining = dict(self.uses)
+      for shared, raw, qty, factor in self.split:
+         # Shared products, raw fields through the raw cache, then sub-quantities
+         arrays = [self.shared(sub, products, remaining) for sub in shared] \
+                + [read_one(self.case, item) for item in raw + qty]
+         if len(arrays) == 0:
+            total.add(factor)
+            continue
+         output = arrays[0]
+         if len(arrays) > 1:
+            np.multiply(arrays[0], arrays[1], out=buf)
+            for array in arrays[2:]:
+               np.multiply(buf, array, out=buf)
+            output = buf
+         if factor != 1.:
+            np.multiply(output, factor, out=buf)
+            output = buf
+         total.add(output)
+      # Raw fields not read, the shared products being already computed, leave the look-ahead window
+      self.case.cache.cancel(self.raw)
+      data = total.data
+      if self.scaling != 1.:
+         np.multiply(data, self.scaling, out=data)
+      return data
 
 #
 # Create a class for a given quantity
@@ -134,61 +1476,124 @@ class setup:
 class quantity:
    #
    # Initialize with a config file
+   #   lazy : only read the config, the data is loaded or computed on first access
+   #          (default: lazy mode of the case)
    #
-   def __init__(self, case, config):
+   def __init__(self, case, config, lazy = None):
       # Corresponding setup
       self.case = case
       # Name of the config file
       self.config = np.str(config)
-      # Value of the quantity on the 2D grid
-      self.data = np.zeros((case.nx, case.ny))
       #
-      # Read the config file
+      # Read the config file, parsed once
       #
-      tmp = []
-      for line in open(self.config,"r").read().splitlines():
-         if line[0] != "#":
-            tmp.append(line)
+      self.parsed = parse_quantity(self.config)
       
       # Name of the quantity for legends
-      self.name = np.str(tmp[0])
+      self.name = self.parsed.name
       # Number of terms in the quantity
-      self.nterms = np.int(tmp[1])
-      # Check if the quantity was already processed => read or compute
-      if opisfile(ospjoin(case.postfolder, self.config[:-4] + ".hdf")):
-         h5f = hp.File(ospjoin(case.postfolder, self.config[:-4] + ".hdf"), 'r')
-         self.data = h5f[self.config[:-4]][:]
-         h5f.close()
+      self.nterms = self.parsed.nterms
+      
+      # Optional parameters for 1D plots
+      self.clr = self.parsed.clr
+      self.mrkedgeclr = self.parsed.mrkedgeclr
+      self.mrkfaceclr = 'none'
+      self.markevery = self.parsed.markevery
+      
+      # Load or compute the data now, or on first access
+      if lazy is None:
+         lazy = case.lazy
+      if not lazy:
+         self.load()
+   
+   #
+   # Load or compute the data and the basic metrics
+   #
+   def load(self):
+      if self.config == "Auto":
+         # Sum of the other terms of a budget
+         total = accumulator((self.case.nx, self.case.ny), self.case.dtype, self.case.compensated)
+         for term in self.parts:
+            total.add(term.data)
+         data = total.data
       else:
-         # Put each term inside data
-         for iterm in range(np.abs(self.nterms)):
-            term = np.ones((case.nx, case.ny))
-            list_term = tmp[iterm+2].split()
-            for item in range(len(list_term)-1):
-               term = term * read_one(case, np.str(list_term[item]))
-            
-            self.data = self.data + term * get_scaling(case, list_term[-1])
-         
-         self.data = self.data * get_scaling(case, tmp[self.nterms+2])
-         h5f = hp.File(ospjoin(case.postfolder, self.config[:-4] + ".hdf"), 'w')
-         h5f.create_dataset(self.config[:-4], data=self.data)
-         h5f.close()
+         with span(self.case, self.config, "quantity"):
+            # Check if the quantity was already processed and is up to date => read or compute
+            self.key = get_key(self.case, self.config)
+            data = load_hdf(self.case, self.config, self.key)
+            if data is None:
+               # Compile the terms and evaluate them
+               with span(self.case, self.config, "compute"):
+                  data = plan(self.case, self.parsed.terms, self.parsed.scaling, self.config).run()
+               save_hdf(self.case, self.config, data, self.key)
+            # The products shared with other quantities are not needed by this one anymore
+            self.case.products.release(self.config)
+      self.data = data
       # Some basic metrics
       self.min = np.min(self.data)
       self.max = np.max(self.data)
       self.absmax = np.max(np.abs(self.data))
-      
-      # Optional parameters for 1D plots
-      if len(tmp) > self.nterms+3:
-         self.clr = np.str(tmp[self.nterms+3])
-         self.mrkedgeclr = np.str(tmp[self.nterms+4])
-         self.mrkfaceclr = 'none'
-         self.markevery = np.int(tmp[self.nterms+5])
-      else :
-         self.clr = None
-         self.mrkedgeclr = 'none'
-         self.mrkfaceclr = 'none'
-         self.markevery = 'none'
+   
+   #
+   # Release the data and the basic metrics, they are loaded again on next access
+   #
+   def release(self):
+      for name in ("data", "min", "max", "absmax", "lods"):
+         self.__dict__.pop(name, None)
+   
+   #
+   # Level-of-detail pyramid of the data, for the 2D plots of large grids
+   #   Level n averages blocks of 2**n x 2**n nodes, level 0 is the data
+   #   Each level is built once from the previous one and saved next to the processed data
+   # Returns a 2D array of size about (nx/2**level, ny/2**level)
+   #
+   def lod(self, level):
+      if level == 0:
+         return self.data
+      lods = self.__dict__.setdefault("lods", {})
+      if level not in lods:
+         output = None
+         if self.config != "Auto":
+            if "key" not in self.__dict__:
+               self.key = get_key(self.case, self.config)
+            output = load_hdf(self.case, self.config, self.key, level=level)
+         if output is None:
+            output = coarsen(self.lod(level - 1))
+            if self.config != "Auto":
+               save_hdf(self.case, self.config, output, self.key, level)
+         lods[level] = output
+      return lods[level]
+   
+   #
+   # Extract part of the data, for instance np.s_[i,:] for one profile
+   #   Data already in memory is sliced
+   #   Processed data is read with a hyperslab selection, without loading the full 2D field
+   #   Otherwise the data is loaded or computed
+   #
+   def extract(self, index):
+      if "data" in self.__dict__:
+         return self.data[index]
+      if self.config == "Auto":
+         parts = [term.extract(index) for term in self.parts]
+         total = accumulator(np.shape(parts[0]), self.case.dtype, self.case.compensated)
+         for part in parts:
+            total.add(part)
+         return total.data[()]
+      if "key" not in self.__dict__:
+         self.key = get_key(self.case, self.config)
+      output = load_hdf(self.case, self.config, self.key, index)
+      if output is None:
+         output = self.data[index]
+      return output
+   
+   #
+   # Load the data and the basic metrics on first access
+   #
+   def __getattr__(self, name):
+      if name in ("data", "min", "max", "absmax") and "config" in self.__dict__:
+         self.load()
+         return self.__dict__[name]
+      raise AttributeError(name)
    
    #
    # Add post-processing
@@ -205,10 +1610,20 @@ class quantity:
       return ijval(i, j, self)
    def xyval(self, x, y):
       return xyval(x, y, self)
-   def xyplot(self, fig = None, ax = None):
-      return xyplot(self, fig, ax)
-   def xyctr(self, fig = None, ax = None):
-      return xyctr(self, fig, ax)
+   def xyprobe(self, x, y, method = "nearest"):
+      return xyprobe(x, y, self, method)
+   def integrate(self, x0 = 0., x1 = 1., y0 = 0., y1 = 1.):
+      return integrate(self, x0, x1, y0, y1)
+   def mean(self):
+      return box_average(self)
+   def box_average(self, x0 = 0., x1 = 1., y0 = 0., y1 = 1.):
+      return box_average(self, x0, x1, y0, y1)
+   def line_average(self, axis, lo = 0., hi = 1.):
+      return line_average(axis, self, lo, hi)
+   def xyplot(self, fig = None, ax = None, resolution = None):
+      return xyplot(self, fig, ax, resolution)
+   def xyctr(self, fig = None, ax = None, resolution = None):
+      return xyctr(self, fig, ax, resolution)
    #
    # Add basic and detailed description
    #
@@ -232,104 +1647,262 @@ class quantity:
 class budget:
    #
    # Initialize with a config file
+   #   lazy : only read the config files, the data is loaded or computed on first access
+   #          (default: lazy mode of the case)
    #
-   def __init__(self, case, config):
+   def __init__(self, case, config, lazy = None):
       # Corresponding setup
       self.case = case
       # Name of the config file
       self.config = np.str(config)
+      if lazy is None:
+         lazy = case.lazy
       #
-      # Read the config file
+      # Read the config file, parsed once
       #   Comment line(s) start with '#'
       #   Followed by some mandatory fields
       #     Name of the budget
       #     the quantity file for each term
       #     "Y" or "N" to compute the error
       #
-      tmp = []
-      for line in open(self.config,"r").read().splitlines():
-         if line[0] != "#":
-            tmp.append(line)
+      parsed = parse_budget(self.config)
       # Name
-      self.name = np.str(tmp[0])
+      self.name = parsed.name
       # Number of terms in the budget
-      self.nterms = np.int(len(tmp)-2)
+      self.nterms = len(parsed.qty_list)
       # List of the terms
-      self.qty_list = tmp[1:self.nterms+1]
+      self.qty_list = list(parsed.qty_list)
       # Build each term in the budget
       self.terms = []
       for term in self.qty_list:
-         self.terms.append(quantity(case, term))
+         self.terms.append(quantity(case, term, lazy))
       
       # Compute the error ?
-      if tmp[-1]=="Y" or tmp[-1]=="y":
+      self.error = parsed.error
+      if self.error:
          self.nterms = self.nterms + 1
          error = quantity.__new__(quantity)
          error.case = case
          error.config = "Auto"
          error.name = "Error"
          error.nterms = self.nterms - 1
-         error.data = np.zeros((case.nx, case.ny))
-         for term in self.terms:
-            error.data = error.data + term.data
-         error.min = np.min(error.data)
-         error.max = np.max(error.data)
-         error.absmax = np.max(np.abs(error.data))
+         error.parts = list(self.terms)
          error.clr = ":k"
          error.mrkedgeclr = 'none'
          error.mrkfaceclr = 'none'
          error.markevery = 'none'
          self.terms.append(error)
+      
+      # Stack the data of all terms now, the error is computed from the stacked array
+      if not lazy:
+         self.load()
+   
+   #
+   # Stack the data of all terms in one array of size (nterms, nx, ny)
+   #   The data of each term becomes a view of the stacked array
+   #   The error is the sum over the other terms
+   #   Per-term metrics are arrays of size nterms
+   #
+   def load(self):
+      with span(self.case, self.config, "budget"):
+         data = np.empty((self.nterms, self.case.nx, self.case.ny), self.case.dtype)
+         nquantities = self.nterms - 1 if self.error else self.nterms
+         # Read the raw fields of all the terms to compute in the background, ahead of the arithmetic
+         files = []
+         if self.case.cache.depth > 0:
+            for term in self.terms[:nquantities]:
+               if "data" not in term.__dict__:
+                  term.key = get_key(self.case, term.config)
+                  if not has_hdf(self.case, term.config, term.key):
+                     files.extend(term.parsed.raw)
+            self.case.cache.prefetch(files)
+         for k in range(nquantities):
+            data[k] = self.terms[k].data
+            self.terms[k].data = data[k]
+         self.case.cache.cancel(files)
+         if self.error:
+            if self.case.compensated:
+               total = accumulator((self.case.nx, self.case.ny), self.case.dtype, True)
+               for k in range(nquantities):
+                  total.add(data[k])
+               data[-1] = total.data
+            else:
+               np.sum(data[:-1], axis=0, out=data[-1])
+            error = self.terms[-1]
+            error.data = data[-1]
+            error.min = np.min(error.data)
+            error.max = np.max(error.data)
+            error.absmax = np.max(np.abs(error.data))
+         self.data = data
+         # Some basic metrics for each term
+         self.min = np.min(data, axis=(1,2))
+         self.max = np.max(data, axis=(1,2))
+         self.absmax = np.max(np.abs(data), axis=(1,2))
+   
+   #
+   # Relative contribution of each term, |term| / sum(|terms|)
+   # Returns an array of size (nterms, nx, ny)
+   #
+   def fractions(self):
+      absdata = np.abs(self.data)
+      return absdata / np.sum(absdata, axis=0)
+   
+   #
+   # Residual of the budget, sum of all terms except the error
+   # Returns an array of size (nx, ny)
+   #
+   def residual(self):
+      if self.error:
+         return self.data[-1]
+      return np.sum(self.data, axis=0)
+   
+   #
+   # Normalized residual map, |residual| / max(|term|) at each node
+   #   Nodes where all terms vanish get 0
+   # Returns an array of size (nx, ny)
+   #
+   def residual_map(self):
+      terms = self.data[:-1] if self.error else self.data
+      dominant = np.max(np.abs(terms), axis=0)
+      output = np.zeros(dominant.shape, dominant.dtype)
+      np.divide(np.abs(self.residual()), dominant, out=output, where=dominant > 0.)
+      return output
+   
+   #
+   # Closure of the budget in the box [x0, x1] x [y0, y1] (default: whole domain)
+   #   L1 and L2 norms use the integration weights of the box, see setup.box_weights
+   #   Each norm of the residual is divided by the largest norm among the terms
+   # Returns the relative L1, L2 and Linf norms of the residual
+   #
+   def closure(self, x0 = 0., x1 = 1., y0 = 0., y1 = 1.):
+      terms = self.data[:-1] if self.error else self.data
+      # Integration weights of the box, as for integrate and box_average
+      weights = self.case.box_weights(x0, x1, y0, y1)
+      if weights is None:
+         return None
+      w = np.outer(weights[0], weights[1])
+      mask = w != 0.
+      res = np.abs(self.residual())
+      absterms = np.abs(terms)
+      l1 = np.sum(w * res) / np.max(np.sum(w * absterms, axis=(1,2)))
+      l2 = np.sqrt(np.sum(w * res**2) / np.max(np.sum(w * absterms**2, axis=(1,2))))
+      linf = np.max(res[mask]) / np.max(absterms[:,mask])
+      return np.array([l1, l2, linf])
+   
+   #
+   # Nodes with the largest normalized residual
+   # Returns an array of size (n, 5) : i, j, x, y, normalized residual
+   #
+   def worst(self, n = 10):
+      nmap = self.residual_map()
+      n = min(n, nmap.size)
+      flat = np.argpartition(nmap.ravel(), -n)[-n:]
+      flat = flat[np.argsort(nmap.ravel()[flat])[::-1]]
+      i, j = np.unravel_index(flat, nmap.shape)
+      return np.column_stack((i, j, self.case.xx[i], self.case.yy[j], nmap[i, j]))
+   
+   #
+   # Release the data of all terms, they are loaded again on next access
+   #
+   def release(self):
+      for name in ("data", "min", "max", "absmax"):
+         self.__dict__.pop(name, None)
+      for term in self.terms:
+         term.release()
+   
+   #
+   # Stack the data of all terms on first access
+   #
+   def __getattr__(self, name):
+      if name in ("data", "min", "max", "absmax") and "terms" in self.__dict__:
+         self.load()
+         return self.__dict__[name]
+      raise AttributeError(name)
+   
+   #
+   # Extract part of the data of all terms, for instance np.s_[i,:] for one profile
+   #   From the stacked array if present, otherwise each term is extracted once
+   #   The error is the sum of the parts of the other terms
+   # Returns an array of size (nterms, ...)
+   #
+   def extract(self, index):
+      if "data" in self.__dict__:
+         return self.data[(slice(None),) + np.index_exp[index]]
+      nquantities = self.nterms - 1 if self.error else self.nterms
+      parts = [term.extract(index) for term in self.terms[:nquantities]]
+      if self.error:
+         total = accumulator(np.shape(parts[0]), self.case.dtype, self.case.compensated)
+         for part in parts:
+            total.add(part)
+         parts.append(total.data[()])
+      return np.array(parts)
    
    #
    # Add post-processing
    #
    def iplot(self, i, fig = None, ax = None):
+      import matplotlib.pyplot as plt
       # New figure and axes if none provided
       if fig == None or ax == None:
          fig, ax = plt.subplots()
-      # Plot all terms
-      for term in self.terms:
-         fig, ax = term.iplot(i, fig, ax)
+      # Plot all terms, extracted together
+      values = self.extract(np.s_[i,:]) if 0 <= i < self.case.nx else [None] * self.nterms
+      for term, value in zip(self.terms, values):
+         fig, ax = iplot(i, term, fig, ax, value)
       ax.set_ylabel(self.name)
       ax.legend()
       return [fig, ax]
    def jplot(self, j, fig = None, ax = None):
+      import matplotlib.pyplot as plt
       # New figure and axes if none provided
       if fig == None or ax == None:
          fig, ax = plt.subplots()
-      # Plot all terms
-      for term in self.terms:
-         fig, ax = term.jplot(j, fig, ax)
+      # Plot all terms, extracted together
+      values = self.extract(np.s_[:,j]) if 0 <= j < self.case.ny else [None] * self.nterms
+      for term, value in zip(self.terms, values):
+         fig, ax = jplot(j, term, fig, ax, value)
       ax.set_ylabel(self.name)
       ax.legend()
       return [fig, ax]
    def xplot(self, x, fig = None, ax = None):
-      # New figure and axes if none provided
-      if fig == None or ax == None:
-         fig, ax = plt.subplots()
-      # Plot all terms
-      for term in self.terms:
-         fig, ax = term.xplot(x, fig, ax)
-      ax.set_ylabel(self.name)
-      ax.legend()
-      return [fig, ax]
+      if x<0. or x>1.:
+         print("Incorrect value for x in xplot : " + np.str(x))
+         return None
+      return self.iplot(self.case.locate_x(x), fig, ax)
    def yplot(self, y, fig = None, ax = None):
-      # New figure and axes if none provided
-      if fig == None or ax == None:
-         fig, ax = plt.subplots()
-      # Plot all terms
-      for term in self.terms:
-         fig, ax = term.yplot(y, fig, ax)
-      ax.set_ylabel(self.name)
-      ax.legend()
-      return [fig, ax]
+      if y<0. or y>1.:
+         print("Incorrect value for y in yplot : " + np.str(y))
+         return None
+      return self.jplot(self.case.locate_y(y), fig, ax)
+   # Values of all terms, extracted together
    def ijval(self, i, j):
+      if 0 <= i < self.case.nx and 0 <= j < self.case.ny:
+         return self.extract(np.s_[i, j])
       return np.array([term.ijval(i,j) for term in self.terms])
    def xyval(self, x, y):
+      if 0. <= x <= 1. and 0. <= y <= 1.:
+         i, j = self.case.locate(x, y)
+         return self.extract(np.s_[i, j])
       return np.array([term.xyval(x,y) for term in self.terms])
+   # Values of all terms at many locations, one reduction over the stacked array
+   def xyprobe(self, x, y, method = "nearest"):
+      stencil = self.case.stencil(x, y, method)
+      if stencil is None:
+         return None
+      i, j, w = stencil
+      return np.sum(w * self.data[:, i, j], axis=1)
+   # Integrals and averages of all terms, one contraction over the stacked array
+   def integrate(self, x0 = 0., x1 = 1., y0 = 0., y1 = 1.):
+      return integrate(self, x0, x1, y0, y1)
+   def mean(self):
+      return box_average(self)
+   def box_average(self, x0 = 0., x1 = 1., y0 = 0., y1 = 1.):
+      return box_average(self, x0, x1, y0, y1)
+   def line_average(self, axis, lo = 0., hi = 1.):
+      return line_average(axis, self, lo, hi)
    # Pie chart of the budget
    def pie(self, array, fig = None, ax = None):
+      import matplotlib.pyplot as plt
       # Sort given labels and values
       tmptype = [('label', '<U64'), ('val', np.float)]
       data = np.sort(np.array(array, dtype=tmptype), order='val')
@@ -350,17 +1923,16 @@ class budget:
    # Pie chart of the budget at given location (i, j)
    def ijpie(self, i, j, fig = None, ax = None):
       # Plot
-      fig, ax = self.pie([(term.name, term.ijval(i,j)) for term in self.terms], fig, ax)
+      fig, ax = self.pie(list(zip([term.name for term in self.terms], self.ijval(i,j))), fig, ax)
       # Add suptitle
       fig.suptitle(np.str(self.name) + " at (i,j)=(" + np.str(i) + "," + np.str(j) + ").")
       return fig, ax
    # Pie chart of the budget at given location (x,y)
    def xypie(self, x, y, fig = None, ax = None):
       # Plot
-      fig, ax = self.pie([(term.name, term.xyval(x,y)) for term in self.terms], fig, ax)
+      fig, ax = self.pie(list(zip([term.name for term in self.terms], self.xyval(x,y))), fig, ax)
       # Locate (x,y) and add suptitle
-      i = np.where(np.abs(self.case.xx-x) == np.amin(np.abs(self.case.xx-x)))[0][0]
-      j = np.where(np.abs(self.case.yy-y) == np.amin(np.abs(self.case.yy-y)))[0][0]
+      i, j = self.case.locate(x, y)
       fig.suptitle(np.str(self.name) + " at (x,y)=(" + np.str(self.case.xx[i]) + "," + np.str(self.case.yy[j]) + ").")
       return fig, ax
    #
@@ -375,10 +1947,374 @@ class budget:
              "   Name : " + self.name + "\n" \
              "   nterms : " + np.str(self.nterms)
 
+#
+# Create a class to average raw snapshots into mean fields
+#   Snapshots are processed one at a time, the memory does not depend on their number
+#   Running mean (Welford) : mean_n = mean_n-1 + (x_n - mean_n-1) / n
+#   Optional checkpoint file to resume an interrupted run
+#
+class averager:
+   #
+   # Initialize with a config file
+   #   Comment line(s) start with '#'
+   #   One term per line
+   #     name of the output file, items of the product, last item is a floating point number
+   #     for instance : uumean.dat u u 1.0
+   #   Terms with the same output file are summed
+   #   Each item is a binary file <item>.dat in each snapshot folder
+   #
+   def __init__(self, case, config, checkpoint = None):
+      # Corresponding setup
+      self.case = case
+      # Name of the config file
+      self.config = np.str(config)
+      # Mean fields : output file -> list of (items, scaling factor)
+      self.fields = OrderedDict()
+      for line in open(self.config,"r").read().splitlines():
+         if not line.strip() or line[0] == "#":
+            continue
+         list_term = line.split()
+         self.fields.setdefault(list_term[0], []).append((list_term[1:-1], get_scaling(case, list_term[-1])))
+      # Checkpoint file
+      self.checkpoint = checkpoint
+      # Number of snapshots, processed snapshots and running means
+      self.n = 0
+      self.done = []
+      self.means = OrderedDict((name, np.zeros((case.ny, case.nx))) for name in self.fields)
+      if checkpoint and opisfile(checkpoint):
+         self.restore()
+   
+   #
+   # Read one field of a snapshot
+   # Returns a 2D array of size (ny, nx), as stored in the binary files
+   #
+   def read(self, snapshot, item):
+      return np.fromfile(ospjoin(snapshot, item + ".dat"), dtype=self.case.rawdtype).reshape((self.case.ny, self.case.nx))
+   
+   #
+   # Add one snapshot (folder) to the running means
+   #
+   def add(self, snapshot):
+      # Each field of the snapshot is read once
+      items = set()
+      for terms in self.fields.values():
+         for list_items, scaling in terms:
+            items.update(list_items)
+      fields = dict((item, self.read(snapshot, item)) for item in items)
+      self.n = self.n + 1
+      buf = np.empty((self.case.ny, self.case.nx))
+      term = np.empty((self.case.ny, self.case.nx))
+      for name, terms in self.fields.items():
+         buf.fill(0.)
+         for list_items, scaling in terms:
+            term.fill(scaling)
+            for item in list_items:
+               np.multiply(term, fields[item], out=term)
+            np.add(buf, term, out=buf)
+         # mean = mean + (x - mean) / n
+         np.subtract(buf, self.means[name], out=buf)
+         np.multiply(buf, 1. / self.n, out=buf)
+         np.add(self.means[name], buf, out=self.means[name])
+      self.done.append(np.str(snapshot))
+   
+   #
+   # Add all snapshots, skip the ones already processed
+   #   every : number of snapshots between two checkpoints
+   #
+   def run(self, snapshots, every = 10):
+      for snapshot in snapshots:
+         if np.str(snapshot) in self.done:
+            continue
+         self.add(snapshot)
+         if self.checkpoint and self.n % every == 0:
+            self.dump()
+      if self.checkpoint:
+         self.dump()
+   
+   #
+   # Write the mean fields, in the raw folder of the case by default
+   #
+   def save(self, folder = None):
+      if folder is None:
+         folder = self.case.rawfolder
+      for name in self.means:
+         self.means[name].astype(self.case.rawdtype).tofile(ospjoin(folder, name))
+   
+   #
+   # Write the checkpoint file, the previous one is replaced once the new one is complete
+   #
+   def dump(self):
+      import h5py as hp
+      h5f = hp.File(self.checkpoint + ".tmp", 'w')
+      h5f.attrs["n"] = self.n
+      h5f.attrs["config"] = self.config
+      h5f.create_dataset("done", data=np.array(self.done, dtype=object), dtype=hp.string_dtype())
+      for name in self.means:
+         h5f.create_dataset(name, data=self.means[name])
+      h5f.close()
+      osreplace(self.checkpoint + ".tmp", self.checkpoint)
+   
+   #
+   # Read the checkpoint file
+   # Raises ValueError if the checkpoint was written for another config file or other mean fields
+   #
+   def restore(self):
+      import h5py as hp
+      with hp.File(self.checkpoint, 'r') as h5f:
+         config = h5f.attrs.get("config")
+         config = config.decode() if isinstance(config, bytes) else np.str(config)
+         if config != self.config:
+            raise ValueError("Checkpoint file " + self.checkpoint + " was written for the config file " + config + ", not " + self.config)
+         missing = [name for name in self.means if name not in h5f]
+         extra = [name for name in h5f if name != "done" and name not in self.means]
+         if missing or extra:
+            raise ValueError("Mean fields of the checkpoint file " + self.checkpoint + " differ from the config file " + self.config + \
+                             ", missing : " + " ".join(missing) + ", not in the config file : " + " ".join(extra))
+         self.n = np.int(h5f.attrs["n"])
+         self.done = [done.decode() if isinstance(done, bytes) else np.str(done) for done in h5f["done"][:]]
+         for name in self.means:
+            self.means[name] = h5f[name][:]
+   
+   #
+   # Add basic and detailed description
+   #
+   def __repr__(self):
+      return self.config
+   def __str__(self):
+      return np.str(self.case) + "\n" \
+             "Setup of the averager :" + "\n" \
+             "   Config file : " + self.config + "\n" \
+             "   Number of mean fields : " + np.str(len(self.fields)) + "\n" \
+             "   Number of snapshots : " + np.str(self.n) + "\n" \
+             "   Checkpoint file : " + np.str(self.checkpoint) + "\n"
+
+#
+# Create a class to build all the quantities and budgets of a case
+#   The dependencies qty -> qty -> raw are collected in a graph
+#   Independent quantities are computed concurrently
+#
+class builder:
+   #
+   # Initialize with the quantity and budget config files
+   #   All config files are parsed and checked before any computation
+   #   The graph does not depend on the case, which is only needed to run
+   #
+   def __init__(self, case, quantities = None, budgets = None):
+      # Corresponding setup
+      self.case = case
+      # Quantity and budget config files
+      self.quantities = list(quantities) if quantities else []
+      self.budgets = list(budgets) if budgets else []
+      # Sub-quantities and raw fields used by each quantity
+      self.children = OrderedDict()
+      self.raw = OrderedDict()
+      for config in self.budgets:
+         for term in parse_budget(config).qty_list:
+            self.add(term)
+      for config in self.quantities:
+         self.add(config)
+      # Quantities sorted such that sub-quantities come first
+      self.order = self.sort()
+   
+   #
+   # Add one quantity and its sub-quantities to the graph
+   #
+   def add(self, config):
+      stack = [config]
+      while stack:
+         node = stack.pop()
+         if node in self.children:
+            continue
+         parsed = parse_quantity(node)
+         self.children[node] = parsed.children
+         self.raw[node] = parsed.raw
+         stack.extend(self.children[node])
+   
+   #
+   # Topological sort of the graph, stop if a cycle is found
+   #
+   def sort(self):
+      order = []
+      # 0 : not visited, 1 : in progress, 2 : done
+      state = dict.fromkeys(self.children, 0)
+      for root in self.children:
+         if state[root]:
+            continue
+         state[root] = 1
+         path = [root]
+         stack = [iter(self.children[root])]
+         while stack:
+            child = next(stack[-1], None)
+            if child is None:
+               node = path.pop()
+               stack.pop()
+               state[node] = 2
+               order.append(node)
+            elif state[child] == 1:
+               cycle = path[path.index(child):] + [child]
+               raise ValueError("Cycle in the quantities : " + " -> ".join(cycle))
+            elif state[child] == 0:
+               state[child] = 1
+               path.append(child)
+               stack.append(iter(self.children[child]))
+      return order
+   
+   #
+   # Build all the quantities, then the budgets
+   #   nworkers : number of threads or processes (default: number of cores)
+   #   processes : use a process pool instead of a thread pool
+   # Returns a dictionary config -> quantity / budget
+   #   With processes, the quantities are loaded back from the post-processed data
+   #
+   def run(self, nworkers = None, processes = False):
+      output = OrderedDict()
+      # Number of sub-quantities not yet built, and reverse dependencies
+      pending = dict((node, len(self.children[node])) for node in self.order)
+      parents = dict((node, []) for node in self.order)
+      for node in self.order:
+         for child in self.children[node]:
+            parents[child].append(node)
+      # A single store can not be written by several processes
+      if processes and self.case.store is not None:
+         print("Single store of the case in use, threads are used instead of processes")
+         processes = False
+      if processes:
+         pool = ProcessPoolExecutor(nworkers, initializer=builder_init, initargs=(self.case.config, self.case.options))
+      else:
+         pool = ThreadPoolExecutor(nworkers)
+         # Products of raw fields shared by the quantities, computed once by the threads
+         self.case.products.register(self.order)
+      with pool:
+         running = {}
+         for node in self.order:
+            if pending[node] == 0:
+               running[self.submit(pool, node, processes)] = node
+         while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+               node = running.pop(future)
+               output[node] = future.result()
+               for parent in parents[node]:
+                  pending[parent] = pending[parent] - 1
+                  if pending[parent] == 0:
+                     running[self.submit(pool, parent, processes)] = parent
+      if processes:
+         for node in self.order:
+            output[node] = quantity(self.case, node)
+      for config in self.budgets:
+         output[config] = budget(self.case, config)
+      return output
+   
+   #
+   # Submit one quantity to the pool
+   #
+   def submit(self, pool, node, processes):
+      if processes:
+         return pool.submit(builder_run, node)
+      return pool.submit(quantity, self.case, node, False)
+   
+   #
+   # Add basic and detailed description
+   #
+   def __repr__(self):
+      return "builder(" + np.str(len(self.order)) + " quantities, " + np.str(len(self.budgets)) + " budgets)"
+   def __str__(self):
+      return "Setup of the builder :" + "\n" \
+             "   Number of quantities : " + np.str(len(self.order)) + "\n" \
+             "   Number of budgets : " + np.str(len(self.budgets)) + "\n" \
+             "   Number of raw fields : " + np.str(len(set().union(*self.raw.values()))) + "\n"
+
+#
+# Setup of the case in each process of a builder
+#
+builder_case = None
+def builder_init(config, options):
+   global builder_case
+   builder_case = setup(config, **options)
+
+#
+# Build one quantity in a process of a builder
+#
+def builder_run(config):
+   quantity(builder_case, config, False)
+   return None
+
+#
+# Small function to process one case of a sweep
+#   The quantities and budgets are built, then their values are extracted
+#   xy : location (x, y) for xyval
+#   ij : node (i, j) for ijval
+#   options : optional arguments of the setup
+# Returns the config file, Ra, Pr and the list of (column, value)
+#
+def sweep_case(config, quantities = None, budgets = None, xy = None, ij = None, options = None):
+   quantities = list(quantities) if quantities else []
+   budgets = list(budgets) if budgets else []
+   case = setup(config, **(options or {}))
+   objects = builder(case, quantities, budgets).run(1)
+   columns = []
+   for name in budgets + quantities:
+      if name in budgets:
+         labels = [name[:-4] + ":" + term.name for term in objects[name].terms]
+      else:
+         labels = [name[:-4]]
+      # Values of all the terms of a budget, extracted together
+      values = []
+      if xy is not None:
+         values.append(("@xy", np.atleast_1d(objects[name].xyval(xy[0], xy[1]))))
+      if ij is not None:
+         values.append(("@ij", np.atleast_1d(objects[name].ijval(ij[0], ij[1]))))
+      for n, label in enumerate(labels):
+         for suffix, value in values:
+            columns.append((label + suffix, value[n]))
+   return config, case.ra, case.pr, columns
+
+#
+# Small function to plot and save one figure
+#   job : (kind, config, method, arguments, name)
+#         kind is "budget" or "quantity"
+#         method is the name of the plotting method, for instance "xplot"
+#         name is the name of the figure in the figures folder, without extension
+#   objects : dictionary config -> budget / quantity, reused across jobs
+# The figure is closed after saving
+# Returns the name of the figure and the time spent (s)
+#
+def render_figure(case, objects, job):
+   import matplotlib.pyplot as plt
+   start = time.perf_counter()
+   kind, config, method, arguments, name = job
+   if config not in objects:
+      if kind == "budget":
+         objects[config] = budget(case, config)
+      else:
+         objects[config] = quantity(case, config)
+   fig, ax = getattr(objects[config], method)(*arguments)
+   fig.savefig(ospjoin(case.figfolder, name + ".png"))
+   plt.close(fig)
+   return name, time.perf_counter() - start
+
+#
+# Setup of the case in each process of a renderer, with a non-interactive backend
+#
+render_case = None
+render_objects = {}
+def render_init(config, options):
+   import matplotlib.pyplot as plt
+   global render_case
+   plt.switch_backend("Agg")
+   render_case = setup(config, **dict(options, lazy=True))
+
+#
+# Plot and save one figure in a process of a renderer
+#
+def render_run(job):
+   return render_figure(render_case, render_objects, job)
+
 #
 # Plot given quantity at given location x_i for all y
 #
-def iplot(i, qty, fig = None, ax = None):
+def iplot(i, qty, fig = None, ax = None, values = None):
+   import matplotlib.pyplot as plt
    #
    # Safety check
    #
@@ -388,14 +2324,17 @@ def iplot(i, qty, fig = None, ax = None):
    # New figure and axes if none provided
    if fig == None or ax == None:
       fig, ax = plt.subplots()
+   # Values along the line, extracted if not provided
+   if values is None:
+      values = qty.extract(np.s_[i,:])
    if qty.clr == None:
-      ax.plot(qty.case.yy, qty.data[i,:], label=qty.name)
+      ax.plot(qty.case.yy, values, label=qty.name)
    else:
-      ax.plot(qty.case.yy, qty.data[i,:], qty.clr, \
-                                          label=qty.name, \
-                                          markeredgecolor=qty.mrkedgeclr, \
-                                          markerfacecolor=qty.mrkfaceclr, \
-                                          markevery=qty.markevery)
+      ax.plot(qty.case.yy, values, qty.clr, \
+                                                    label=qty.name, \
+                                                    markeredgecolor=qty.mrkedgeclr, \
+                                                    markerfacecolor=qty.mrkfaceclr, \
+                                                    markevery=qty.markevery)
    ax.set_title("At x = " + np.str(qty.case.xx[i]))
    ax.set_ylabel(qty.name)
    ax.set_xlabel(r'$y$')
@@ -404,7 +2343,8 @@ def iplot(i, qty, fig = None, ax = None):
 #
 # Plot given quantity at given location y_j for all x
 #
-def jplot(j, qty, fig = None, ax = None):
+def jplot(j, qty, fig = None, ax = None, values = None):
+   import matplotlib.pyplot as plt
    #
    # Safety check
    #
@@ -414,14 +2354,17 @@ def jplot(j, qty, fig = None, ax = None):
    # New figure and axes if none provided
    if fig == None or ax == None:
       fig, ax = plt.subplots()
+   # Values along the line, extracted if not provided
+   if values is None:
+      values = qty.extract(np.s_[:,j])
    if qty.clr == None :
-      ax.plot(qty.case.xx, qty.data[:,j], label=qty.name)
+      ax.plot(qty.case.xx, values, label=qty.name)
    else:
-      ax.plot(qty.case.xx, qty.data[:,j], qty.clr, \
-                                          label=qty.name, \
-                                          markeredgecolor=qty.mrkedgeclr, \
-                                          markerfacecolor=qty.mrkfaceclr, \
-                                          markevery=qty.markevery)
+      ax.plot(qty.case.xx, values, qty.clr, \
+                                                    label=qty.name, \
+                                                    markeredgecolor=qty.mrkedgeclr, \
+                                                    markerfacecolor=qty.mrkfaceclr, \
+                                                    markevery=qty.markevery)
    ax.set_title("At y = " + np.str(qty.case.yy[j]))
    ax.set_ylabel(qty.name)
    ax.set_xlabel(r'$x$')
@@ -440,7 +2383,7 @@ def xplot(x, qty, fig = None, ax = None):
    #
    # Locate node i
    #
-   i = np.where(np.abs(qty.case.xx-x) == np.amin(np.abs(qty.case.xx-x)))[0][0]
+   i = qty.case.locate_x(x)
    return iplot(i, qty, fig, ax)
 
 #
@@ -456,7 +2399,7 @@ def yplot(y, qty, fig = None, ax = None):
    #
    # Locate node j
    #
-   j = np.where(np.abs(qty.case.yy-y) == np.amin(np.abs(qty.case.yy-y)))[0][0]
+   j = qty.case.locate_y(y)
    return jplot(j, qty, fig, ax)
 
 #
@@ -474,7 +2417,7 @@ def ijval(i, j, qty):
       print("Incorrect value for j in ijval : " + np.str(j))
       return None
    
-   return qty.data[i, j]
+   return qty.extract(np.s_[i, j])
 
 #
 # Extract given quantity at given location x, y
@@ -492,20 +2435,186 @@ def xyval(x, y, qty):
       return None
    
    # Locate i, j
-   i = np.where(np.abs(qty.case.xx-x) == np.amin(np.abs(qty.case.xx-x)))[0][0]
-   j = np.where(np.abs(qty.case.yy-y) == np.amin(np.abs(qty.case.yy-y)))[0][0]
+   i, j = qty.case.locate(x, y)
    return ijval(i, j, qty)
 
+#
+# Extract given quantity at many locations x, y
+#   method : "nearest" node or "linear" (bilinear interpolation)
+#   NaN is returned outside the domain
+# Returns an array of size npoints
+#
+def xyprobe(x, y, qty, method = "nearest"):
+   stencil = qty.case.stencil(x, y, method)
+   if stencil is None:
+      return None
+   return probe(stencil, qty)
+
+#
+# Small function to apply the nodes and weights of a stencil to given quantity
+#
+def probe(stencil, qty):
+   i, j, w = stencil
+   return np.sum(w * qty.data[i, j], axis=0)
+
+#
+# Integral of given quantity, or of all the terms of given budget, in the box [x0, x1] x [y0, y1]
+#   One contraction of the data with the integration weights of the case
+# Returns a float, or an array with one value per term for a budget
+#
+def integrate(qty, x0 = 0., x1 = 1., y0 = 0., y1 = 1.):
+   weights = qty.case.box_weights(x0, x1, y0, y1)
+   if weights is None:
+      return None
+   wx, wy = weights
+   return np.einsum("...ij,i,j->...", qty.data, wx, wy)
+
+#
+# Average of given quantity, or of all the terms of given budget, in the box [x0, x1] x [y0, y1]
+#   Average over the whole domain by default
+#
+def box_average(qty, x0 = 0., x1 = 1., y0 = 0., y1 = 1.):
+   weights = qty.case.box_weights(x0, x1, y0, y1)
+   if weights is None:
+      return None
+   wx, wy = weights
+   return np.einsum("...ij,i,j->...", qty.data, wx, wy) / (np.sum(wx) * np.sum(wy))
+
+#
+# Average of given quantity, or of all the terms of given budget, along x (axis 0) or y (axis 1)
+#   Optional range [lo, hi] along the averaged direction
+# Returns a profile of size ny (axis 0) or nx (axis 1), or one profile per term for a budget
+#
+def line_average(axis, qty, lo = 0., hi = 1.):
+   if axis not in (0, 1):
+      print("Incorrect axis in line_average : " + np.str(axis))
+      return None
+   weights = qty.case.box_weights(*((lo, hi, 0., 1.) if axis == 0 else (0., 1., lo, hi)))
+   if weights is None:
+      return None
+   w = weights[axis]
+   return np.einsum("...ij," + ("i->...j" if axis == 0 else "j->...i"), qty.data, w) / np.sum(w)
+
+#
+# Extract the profiles and the probe values of quantities and budgets in columns, one row per value
+#   objects : list of quantities and budgets, all the terms of a budget are extracted at once
+#   x, y, i, j : locations of the profiles, as for xplot, yplot, iplot and jplot
+#   px, py : probe locations, with the interpolation method ("nearest" or "linear")
+# Returns a dictionary of 1D arrays with the same length
+#   source : config file of the quantity or of the budget
+#   term : name of the quantity or of the term of the budget
+#   kind : "x", "y", "i", "j" for the profiles, "probe" for the probe values
+#   station : location of the profile, or index of the probe location
+#   i, j, x, y : node and location of the value (nearest node of the probe location)
+#   value
+#
+def export_columns(objects, x = None, y = None, i = None, j = None, px = None, py = None, method = "nearest"):
+   blocks = []
+   for obj in objects:
+      case = obj.case
+      if isinstance(obj, budget):
+         data = obj.data
+         names = [term.name for term in obj.terms]
+      else:
+         data = obj.data[np.newaxis]
+         names = [obj.name]
+      # Profiles along y at given nodes i, along x at given nodes j
+      for kind, stations in (("x", x), ("i", i), ("y", y), ("j", j)):
+         if stations is None or len(stations) == 0:
+            continue
+         stations = np.asarray(stations)
+         if kind in ("x", "y"):
+            valid = (stations >= 0.) & (stations <= 1.)
+         else:
+            valid = (stations >= 0) & (stations <= (case.nx if kind == "i" else case.ny) - 1)
+         for station in stations[~valid]:
+            print("Incorrect value for " + kind + " in export_columns : " + np.str(station))
+         stations = stations[valid]
+         if kind == "x":
+            nodes = case.locate_x(stations)
+         elif kind == "y":
+            nodes = case.locate_y(stations)
+         else:
+            nodes = stations.astype(int)
+         if kind in ("x", "i"):
+            values = data[:, nodes, :]
+            ii, jj = np.meshgrid(nodes, np.arange(case.ny), indexing="ij")
+         else:
+            values = np.swapaxes(data[:, :, nodes], 1, 2)
+            jj, ii = np.meshgrid(nodes, np.arange(case.nx), indexing="ij")
+         station = np.broadcast_to(stations[:,np.newaxis], ii.shape)
+         blocks.append((obj.config, names, kind, station, ii, jj, case.xx[ii], case.yy[jj], values))
+      # Probe values, one reduction over all terms
+      if px is not None and len(px) > 0:
+         stencil = case.stencil(px, py, method)
+         if stencil is None:
+            continue
+         si, sj, w = stencil
+         values = np.sum(w * data[:, si, sj], axis=1)[:,np.newaxis,:]
+         ii, jj = case.locate(px, py)
+         blocks.append((obj.config, names, "probe", np.arange(len(px))[np.newaxis], np.asarray(ii)[np.newaxis], \
+                        np.asarray(jj)[np.newaxis], np.asarray(px)[np.newaxis], np.asarray(py)[np.newaxis], values))
+   # Concatenate the blocks, the coordinates are repeated for each term
+   columns = dict((name, []) for name in ("source", "term", "kind", "station", "i", "j", "x", "y", "value"))
+   for source, names, kind, station, ii, jj, xx, yy, values in blocks:
+      nterms, npts = len(names), ii.size
+      columns["source"].append(np.full(nterms * npts, source))
+      columns["term"].append(np.repeat(np.array(names), npts))
+      columns["kind"].append(np.full(nterms * npts, kind))
+      for name, array in (("station", station), ("i", ii), ("j", jj), ("x", xx), ("y", yy)):
+         columns[name].append(np.tile(np.ravel(array), nterms))
+      columns["value"].append(np.ravel(values))
+   for name in columns:
+      columns[name] = np.concatenate(columns[name]) if columns[name] else np.array([])
+   columns["station"] = columns["station"].astype(float)
+   return columns
+
+#
+# Save the columns of export_columns in one file, the format is given by the extension
+#   .npz : one array per column
+#   .h5, .hdf or .hdf5 : one dataset per column, in the group "table"
+#   .csv : one line per value, with a header
+#   Optional metadata (dictionary of str), saved as arrays, attributes or comment lines
+#
+def save_columns(file, columns, meta = None):
+   meta = meta or {}
+   if file.endswith(".npz"):
+      np.savez(file, **dict(columns, **dict(("meta_" + key, np.array(val)) for key, val in meta.items())))
+   elif file.endswith((".h5", ".hdf", ".hdf5")):
+      import h5py as hp
+      with hp.File(file, 'w') as h5f:
+         table = h5f.create_group("table")
+         for name, column in columns.items():
+            if column.dtype.kind == "U":
+               column = np.char.encode(column, "utf-8")
+            table.create_dataset(name, data=column, chunks=True if column.size else None)
+         for key, val in meta.items():
+            table.attrs[key] = val
+   elif file.endswith(".csv"):
+      names = list(columns)
+      rows = np.rec.fromarrays([columns[name] for name in names], names=names)
+      header = "".join("# " + key + " : " + np.str(val) + "\n" for key, val in meta.items()) + ",".join(names)
+      np.savetxt(file, rows, fmt="\"%s\",\"%s\",\"%s\",%.10g,%d,%d,%.10g,%.10g,%.10e", header=header, comments="")
+   else:
+      print("Incorrect file extension for save_columns (.npz, .h5, .hdf, .hdf5 or .csv) : " + file)
+
 #
 # Surface plot of given quantity
+#   Optional target resolution, the number of nodes along the longest direction
+#   The field is then drawn from a coarser level of its pyramid, with all its nodes
 #
-def xyplot(qty, fig = None, ax = None):
+def xyplot(qty, fig = None, ax = None, resolution = None):
+   import matplotlib.pyplot as plt
    from mpl_toolkits.mplot3d import Axes3D
    # New figure and axes if none provided
    if fig == None or ax == None:
       fig, ax = plt.subplots(subplot_kw={"projection": "3d"})
-   xxx, yyy = np.meshgrid(qty.case.xx, qty.case.yy)
-   ps = ax.plot_surface(xxx, yyy, np.transpose(qty.data[:,:]))
+   level = qty.case.level(resolution)
+   xxx, yyy = qty.case.meshgrid(level)
+   if resolution is None:
+      ps = ax.plot_surface(xxx, yyy, np.transpose(qty.data[:,:]))
+   else:
+      ps = ax.plot_surface(xxx, yyy, np.transpose(qty.lod(level)), rcount=xxx.shape[0], ccount=xxx.shape[1])
    #cb = fig.colorbar(ps)
    ax.set_zlabel(qty.name)
    ax.set_ylabel(r'$y$')
@@ -514,13 +2623,17 @@ def xyplot(qty, fig = None, ax = None):
 
 #
 # Contour plot of given quantity
+#   Optional target resolution, the number of nodes along the longest direction
+#   The field is then drawn from a coarser level of its pyramid
 #
-def xyctr(qty, fig = None, ax = None):
+def xyctr(qty, fig = None, ax = None, resolution = None):
+   import matplotlib.pyplot as plt
    # New figure and axes if none provided
    if fig == None or ax == None:
       fig, ax = plt.subplots()
-   xxx, yyy = np.meshgrid(qty.case.xx, qty.case.yy)
-   ct = ax.contour(xxx, yyy, np.transpose(qty.data[:,:]))
+   level = qty.case.level(resolution)
+   xxx, yyy = qty.case.meshgrid(level)
+   ct = ax.contour(xxx, yyy, np.transpose(qty.lod(level)))
    ax.clabel(ct, ct.levels, inline=True, fontsize=10)
    #cb = fig.colorbar(ct)
    ax.set_title(qty.name)
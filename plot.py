@@ -2,134 +2,275 @@
 
 # Import various modules
 import argparse
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import matplotlib.pyplot as plt
 from os.path import join as opjoin
 
 # Import local modules from the file module.py in the current directory
 from module import *
 
 # Small function to show and / or save a Figure
+#   Figures are closed once saved unless they are shown
+#   pyplot is only imported when a figure is requested, printing values does not need it
 def show_and_save(fig, name):
+   import matplotlib.pyplot as plt
    if args.show:
       fig.show()
    if args.save:
       fig.savefig(opjoin(case.figfolder, name+".png"))
+      if not args.show:
+         plt.close(fig)
 
-# Small function to plot and extract values for a given budget / quantity
-def plot_and_save(qty, name):
+# Small function to list the figures for a given budget / quantity
+#   Each figure is (plotting method, arguments, name)
+def plan_figures(name, is_budget = False):
+   figures = []
    if args.x:
       for x in args.x:
-         fig, ax = qty.xplot(x)
-         show_and_save(fig, name[:-4]+"_xplot_x_"+np.str(x))
+         figures.append(("xplot", (x,), name[:-4]+"_xplot_x_"+np.str(x)))
    if args.y:
       for y in args.y:
-         fig, ax = qty.yplot(y)
-         show_and_save(fig, name[:-4]+"_yplot_y_"+np.str(y))
+         figures.append(("yplot", (y,), name[:-4]+"_yplot_y_"+np.str(y)))
    if args.i:
       for i in args.i:
-         fig, ax = qty.iplot(i)
-         show_and_save(fig, name[:-4]+"_iplot_i_"+np.str(i))
+         figures.append(("iplot", (i,), name[:-4]+"_iplot_i_"+np.str(i)))
    if args.j:
       for j in args.j:
-         fig, ax = qty.jplot(j)
-         show_and_save(fig, name[:-4]+"_jplot_j_"+np.str(j))
+         figures.append(("jplot", (j,), name[:-4]+"_jplot_j_"+np.str(j)))
+   if is_budget and args.xypie:
+      figures.append(("xypie", tuple(args.xypie), name[:-4]+"_xypie_x_"+np.str(args.xypie[0])+"_y_"+np.str(args.xypie[1])))
+   if is_budget and args.ijpie:
+      figures.append(("ijpie", tuple(args.ijpie), name[:-4]+"_ijpie_i_"+np.str(args.ijpie[0])+"_j_"+np.str(args.ijpie[1])))
+   return figures
+
+# Small function to plot and extract values for a given budget / quantity
+def plot_and_save(qty, name, is_budget = False):
+   if not (args.batch or args.export):
+      for method, arguments, figname in plan_figures(name, is_budget):
+         fig, ax = getattr(qty, method)(*arguments)
+         show_and_save(fig, figname)
    if args.xyval:
       print(name[:-4] + ", xyval: " + np.str(qty.xyval(args.xyval[0], args.xyval[1])))
    if args.ijval:
       print(name[:-4] + ", ijval: " + np.str(qty.ijval(args.ijval[0], args.ijval[1])))
+   if args.probe and not args.export:
+      values = qty.xyprobe(probe_x, probe_y, args.interp)
+      print(name[:-4] + ", xyprobe (x, y, values):")
+      np.savetxt(sys.stdout, np.column_stack((probe_x, probe_y, np.transpose(values))))
+
+# The script only runs when executed, not when imported by the worker processes of --batch
+#   The helper functions above use args and case, set below
+if __name__ == "__main__":
+
+   # Define and read arguments for the script
+   parser = argparse.ArgumentParser()
+   parser.add_argument("-v", "--verbose", action="store_true")
+   parser.add_argument("--show", help="Show figures", action="store_true")
+   parser.add_argument("--save", help="Save figures", action="store_true")
+   parser.add_argument("-c", "--case", help="Parameter file for the case")
+   parser.add_argument("--store", help="Single HDF5 file in the post-processed folder for all quantities")
+   parser.add_argument("--compression", choices=["gzip", "lzf"], help="Compression of the single HDF5 file")
+   parser.add_argument("--rawdtype", choices=["float32", "float64"], default="float64", help="Data type of the raw binary files")
+   parser.add_argument("--dtype", choices=["float32", "float64"], default="float64", help="Data type of the computations and of the processed data")
+   parser.add_argument("--compensated", help="Compensated summation of the terms", action="store_true")
+   parser.add_argument("--order", type=int, choices=[2, 4], default=2, help="Order of the finite differences for the derivative items d/dx(...) and d/dy(...)")
+   parser.add_argument("--quadrature", choices=["trapezoid", "simpson"], default="trapezoid", help="Integration rule for the closure and the averages")
+   parser.add_argument("--prefetch", type=int, default=0, help="Number of raw files read in the background ahead of the computations (default: 0, no prefetching)")
+   parser.add_argument("-b", "--budget", nargs='+', help="Parameter file(s) for each budget to process")
+   parser.add_argument("-q", "--quantity", nargs='+', help="Parameter file(s) for each quantity to process")
+   parser.add_argument("-x", "--x", nargs='+', type=float, help="Plot budgets / quantities at given x location(s)")
+   parser.add_argument("-y", "--y", nargs='+', type=float, help="Plot budgets / quantities at given y location(s)")
+   parser.add_argument("-i", "--i", nargs='+', type=int, help="Plot budgets / quantities at given i location(s)")
+   parser.add_argument("-j", "--j", nargs='+', type=int, help="Plot budgets / quantities at given j location(s)")
+   parser.add_argument("-xyv", "--xyval", nargs=2, type=float, help="Print budgets / quantities values at given x,y location")
+   parser.add_argument("-ijv", "--ijval", nargs=2, type=int, help="Print budgets / quantities values at given i,j location")
+   parser.add_argument("-pr", "--probe", help="Print budgets / quantities values at the x,y locations in the given file (two columns)")
+   parser.add_argument("--interp", choices=["nearest", "linear"], default="nearest", help="Nearest node or bilinear interpolation for --probe")
+   parser.add_argument("-xyp", "--xypie", nargs=2, type=float, help="Plot budgets pie chart at given x,y location")
+   parser.add_argument("-ijp", "--ijpie", nargs=2, type=int, help="Plot budgets pie chart at given i,j location")
+   parser.add_argument("--closure", help="Print the closure (relative L1, L2, Linf residuals) of the budgets", action="store_true")
+   parser.add_argument("--region", nargs=4, type=float, action="append", help="Box x0 x1 y0 y1 for --closure, can be repeated")
+   parser.add_argument("--worst", type=int, default=0, help="Print the given number of nodes with the largest normalized residual")
+   parser.add_argument("--profile", help="Profile the computations and write the profile in the given file (.json trace or .folded stacks)")
+   parser.add_argument("--memory", help="Trace the peak memory of the arrays in the profile (slows every allocation)", action="store_true")
+   parser.add_argument("--batch", help="Plan all figures, then save them in parallel with a non-interactive backend", action="store_true")
+   parser.add_argument("--export", help="Save all profiles (-x, -y, -i, -j) and probe values (--probe) of all terms in one file (.npz, .h5 or .csv) instead of plotting them")
+   parser.add_argument("-n", "--nworkers", type=int, help="Number of worker processes / threads (default: number of cores)")
+   args = parser.parse_args()
+
+   # User must provide the case parameter file
+   if not args.case:
+      print("Error: a case parameter file must be provided.")
+
+   # User must provide at least one quantity or budget
+   if not (args.budget or args.quantity):
+      print("Error: at least one quantity or budget must be provided.")
+
+   # Batch mode only saves figures
+   if args.batch and args.show:
+      print("Error: figures can not be shown in batch mode.")
+      args.show = False
+   if args.batch and args.export:
+      print("Error: figures are not plotted in export mode.")
+      args.batch = False
+   if args.batch:
+      args.save = True
+      import matplotlib
+      matplotlib.use("Agg")
+
+   # Print in case of verbosity
+   if args.verbose:
+      print("\n")
+      print("Script designed to extract and plot turbulent quantities.")
+      print("Verbose turned on")
+      print("Parameter file for the case: " + args.case)
+      if args.budget:
+         print("Provided budget file(s): " + np.str(args.budget))
+      else:
+         print("No budget file provided")
+      if args.quantity:
+         print("Provided quantity file(s): " + np.str(args.quantity))
+      else:
+         print("No quantity file provided")
+      if args.store:
+         print("Single store for the processed data: " + args.store)
+      if args.profile:
+         print("Profile of the computations written in: " + args.profile)
+      if args.export:
+         print("Profiles and probe values exported in: " + args.export)
+      if args.x:
+         print("Plot Y profiles at provided positions x : " + np.str(args.x))
+      if args.y:
+         print("Plot X profiles at provided positions y : " + np.str(args.y))
+      if args.i:
+         print("Plot Y profiles at provided grid nodes i : " + np.str(args.i))
+      if args.y:
+         print("Plot X profiles at provided grid nodes j : " + np.str(args.j))
+      if args.xyval:
+         print("Extract values at position (x,y) : " + np.str(args.xyval))
+      if args.ijval:
+         print("Extract values at node (i,j) : " + np.str(args.ijval))
+      if args.probe:
+         print("Extract values at the positions (x,y) in : " + args.probe + " (" + args.interp + ")")
+      if args.budget and args.xypie:
+         print("Plot budget pie chart at position (x,y) : " + np.str(args.xypie))
+      if args.budget and args.ijpie:
+         print("Plot budget pie chart at node (i,j) : " + np.str(args.ijpie))
+      if args.budget and args.closure:
+         print("Closure of the budgets in the domain and the region(s) : " + np.str(args.region))
+      print("\n")
+
+   # Read the probe locations
+   if args.probe:
+      probe_x, probe_y = np.loadtxt(args.probe, usecols=(0, 1), ndmin=2, unpack=True)
+
+   # Parse and check all the config files before any computation
+   try:
+      graph = builder(None, args.quantity, args.budget)
+   except ValueError as err:
+      print(err)
+      sys.exit(1)
+
+   # Load the case
+   case = setup(args.case, store=args.store, compression=args.compression, lazy=True, \
+                rawdtype=args.rawdtype, dtype=args.dtype, compensated=args.compensated, order=args.order, \
+                quadrature=args.quadrature, prefetch=args.prefetch, profile=bool(args.profile), \
+                memory=args.memory)
+
+   # Closure of the provided budget(s)
+   if args.budget and (args.closure or args.worst):
+      regions = [(0., 1., 0., 1.)] + [tuple(region) for region in (args.region or [])]
+      if args.closure:
+         print("Closure of the budget(s) : relative L1 / L2 / Linf residuals")
+         print("budget | x0 x1 y0 y1 | L1 | L2 | Linf")
+      for sbud in args.budget:
+         bud = budget(case, sbud)
+         if args.closure:
+            for region in regions:
+               norms = bud.closure(*region)
+               if norms is not None:
+                  print(sbud[:-4] + " | " + " ".join(np.str(val) for val in region) + " | " + " | ".join("{:.3e}".format(val) for val in norms))
+         if args.worst:
+            print(sbud[:-4] + ", worst nodes (i, j, x, y, normalized residual):")
+            for i, j, x, y, val in bud.worst(args.worst):
+               print("   " + np.str(np.int(i)) + " " + np.str(np.int(j)) + " " + "{:.4f}".format(x) + " " + "{:.4f}".format(y) + " " + "{:.3e}".format(val))
+         bud.release()
+
+   # Export the profiles and probe values of all terms in one file
+   #   Each budget / quantity is released once extracted
+   if args.export:
+      columns = []
+      for kind, sobj in [(budget, sbud) for sbud in args.budget or []] + [(quantity, sqty) for sqty in args.quantity or []]:
+         obj = kind(case, sobj)
+         columns.append(export_columns([obj], args.x, args.y, args.i, args.j, \
+                                       probe_x if args.probe else None, probe_y if args.probe else None, args.interp))
+         obj.release()
+      columns = dict((name, np.concatenate([column[name] for column in columns])) for name in columns[0])
+      save_columns(args.export, columns, {"case": args.case, "interp": args.interp})
+      if args.verbose:
+         print("Exported " + np.str(len(columns["value"])) + " values in " + args.export)
 
-# Define and read arguments for the script
-parser = argparse.ArgumentParser()
-parser.add_argument("-v", "--verbose", action="store_true")
-parser.add_argument("--show", help="Show figures", action="store_true")
-parser.add_argument("--save", help="Save figures", action="store_true")
-parser.add_argument("-c", "--case", help="Parameter file for the case")
-parser.add_argument("-b", "--budget", nargs='+', help="Parameter file(s) for each budget to process")
-parser.add_argument("-q", "--quantity", nargs='+', help="Parameter file(s) for each quantity to process")
-parser.add_argument("-x", "--x", nargs='+', type=float, help="Plot budgets / quantities at given x location(s)")
-parser.add_argument("-y", "--y", nargs='+', type=float, help="Plot budgets / quantities at given y location(s)")
-parser.add_argument("-i", "--i", nargs='+', type=int, help="Plot budgets / quantities at given i location(s)")
-parser.add_argument("-j", "--j", nargs='+', type=int, help="Plot budgets / quantities at given j location(s)")
-parser.add_argument("-xyv", "--xyval", nargs=2, type=float, help="Print budgets / quantities values at given x,y location")
-parser.add_argument("-ijv", "--ijval", nargs=2, type=int, help="Print budgets / quantities values at given i,j location")
-parser.add_argument("-xyp", "--xypie", nargs=2, type=float, help="Plot budgets pie chart at given x,y location")
-parser.add_argument("-ijp", "--ijpie", nargs=2, type=int, help="Plot budgets pie chart at given i,j location")
-args = parser.parse_args()
-
-# User must provide the case parameter file
-if not args.case:
-   print("Error: a case parameter file must be provided.")
-
-# User must provide at least one quantity or budget
-if not (args.budget or args.quantity):
-   print("Error: at least one quantity or budget must be provided.")
-
-# Print in case of verbosity
-if args.verbose:
-   print("\n")
-   print("Script designed to extract and plot turbulent quantities.")
-   print("Verbose turned on")
-   print("Parameter file for the case: " + args.case)
+   # Process the provided budget(s):
    if args.budget:
-      print("Provided budget file(s): " + np.str(args.budget))
-   else:
-      print("No budget file provided")
+      if args.verbose:
+         print("Number of budget(s): " + np.str(len(args.budget)))
+      for sbud in args.budget:
+         if args.verbose:
+            print("   Processing " + sbud)
+         bud = budget(case, sbud)
+         # Plot profiles and pie charts, extract values
+         plot_and_save(bud, sbud, True)
+
+   # Process the provided quantitie(s):
    if args.quantity:
-      print("Provided quantity file(s): " + np.str(args.quantity))
-   else:
-      print("No quantity file provided")
-   if args.x:
-      print("Plot Y profiles at provided positions x : " + np.str(args.x))
-   if args.y:
-      print("Plot X profiles at provided positions y : " + np.str(args.y))
-   if args.i:
-      print("Plot Y profiles at provided grid nodes i : " + np.str(args.i))
-   if args.y:
-      print("Plot X profiles at provided grid nodes j : " + np.str(args.j))
-   if args.xyval:
-      print("Extract values at position (x,y) : " + np.str(args.xyval))
-   if args.ijval:
-      print("Extract values at node (i,j) : " + np.str(args.ijval))
-   if args.budget and args.xypie:
-      print("Plot budget pie chart at position (x,y) : " + np.str(args.xypie))
-   if args.budget and args.ijpie:
-      print("Plot budget pie chart at node (i,j) : " + np.str(args.ijpie))
-   print("\n")
-
-# Load the case
-case = setup(args.case)
-
-# Process the provided budget(s):
-if args.budget:
-   if args.verbose:
-      print("Number of budget(s): " + np.str(len(args.budget)))
-   for sbud in args.budget:
       if args.verbose:
-         print("   Processing " + sbud)
-      bud = budget(case, sbud)
-      # Plot profiles and extract values
-      plot_and_save(bud, sbud)
-      # Plot pie chart
-      if args.xypie:
-         fig, ax = bud.xypie(args.xypie[0], args.xypie[1])
-         show_and_save(fig, sbud[:-4]+"_xypie_x_"+np.str(args.xypie[0])+"_y_"+np.str(args.xypie[1]))
-      if args.ijpie:
-         fig, ax = bud.ijpie(args.ijpie[0], args.ijpie[1])
-         show_and_save(fig, sbud[:-4]+"_ijpie_i_"+np.str(args.xypie[0])+"_j_"+np.str(args.xypie[1]))
-
-# Process the provided quantitie(s):
-if args.quantity:
-   if args.verbose:
-      print("Number of quantitie(s): " + np.str(len(args.quantity)))
-   for sqty in args.quantity:
+         print("Number of quantitie(s): " + np.str(len(args.quantity)))
+      for sqty in args.quantity:
+         if args.verbose:
+            print("   Processing " + sqty)
+         qty = quantity(case, sqty)
+         # Plot profiles and extract values
+         plot_and_save(qty, sqty)
+
+   # Plot and save all figures in batch mode
+   if args.batch:
+      jobs = []
+      if args.budget:
+         for sbud in args.budget:
+            jobs.extend(("budget", sbud) + figure for figure in plan_figures(sbud, True))
+      if args.quantity:
+         for sqty in args.quantity:
+            jobs.extend(("quantity", sqty) + figure for figure in plan_figures(sqty))
       if args.verbose:
-         print("   Processing " + sqty)
-      qty = quantity(case, sqty)
-      # Plot profiles and extract values
-      plot_and_save(qty, sqty)
-
-# Wait for input at the end
-if args.show:
-   print("Input some random text to close all figures")
-   input()
+         print("Number of figure(s): " + np.str(len(jobs)))
+      # Build the quantities once, before the renderers read them
+      graph.case = case
+      graph.run(args.nworkers)
+      start = time.perf_counter()
+      if case.store is not None:
+         # A single store can not be opened by several processes
+         objects = {}
+         timings = [render_figure(case, objects, job) for job in jobs]
+      else:
+         with ProcessPoolExecutor(args.nworkers, initializer=render_init, initargs=(case.config, case.options)) as pool:
+            timings = list(pool.map(render_run, jobs))
+      # Summary of the time spent per figure
+      print("Time spent per figure (s):")
+      for figname, elapsed in sorted(timings, key=lambda timing: -timing[1]):
+         print("   " + figname + " : " + "{:.3f}".format(elapsed))
+      print("Total wall time (s) : " + "{:.3f}".format(time.perf_counter() - start))
+
+   # Write the profile of the computations
+   #   In batch mode, the computations of the rendering processes are not included
+   if args.profile:
+      case.profile.dump(args.profile, case)
+      if args.verbose:
+         print(case.profile)
+         print(case.cache)
+
+   # Wait for input at the end
+   if args.show:
+      print("Input some random text to close all figures")
+      input()
@@ -0,0 +1,84 @@
+#! /usr/bin/env python3
+
+# Import various modules
+import argparse
+import sys
+from glob import glob
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+# Import local modules from the file module.py in the current directory
+from module import *
+
+# Main function, the worker processes only import this script
+def main():
+   # Define and read arguments for the script
+   parser = argparse.ArgumentParser(description="Process many cases and summarize the values at given location(s)")
+   parser.add_argument("-v", "--verbose", action="store_true")
+   parser.add_argument("-c", "--case", nargs='+', help="Parameter file(s) or glob pattern(s) for the cases")
+   parser.add_argument("-b", "--budget", nargs='+', help="Parameter file(s) for each budget to process")
+   parser.add_argument("-q", "--quantity", nargs='+', help="Parameter file(s) for each quantity to process")
+   parser.add_argument("-xyv", "--xyval", nargs=2, type=float, help="Extract budgets / quantities values at given x,y location")
+   parser.add_argument("-ijv", "--ijval", nargs=2, type=int, help="Extract budgets / quantities values at given i,j location")
+   parser.add_argument("-n", "--nworkers", type=int, help="Number of worker processes (default: number of cores)")
+   parser.add_argument("-o", "--output", help="Save the summary table in the given CSV file")
+   parser.add_argument("--rawdtype", choices=["float32", "float64"], default="float64", help="Data type of the raw binary files")
+   parser.add_argument("--dtype", choices=["float32", "float64"], default="float64", help="Data type of the computations and of the processed data")
+   parser.add_argument("--compensated", help="Compensated summation of the terms", action="store_true")
+   parser.add_argument("--order", type=int, choices=[2, 4], default=2, help="Order of the finite differences for the derivative items d/dx(...) and d/dy(...)")
+   parser.add_argument("--quadrature", choices=["trapezoid", "simpson"], default="trapezoid", help="Integration rule for the closure and the averages")
+   parser.add_argument("--prefetch", type=int, default=0, help="Number of raw files read in the background ahead of the computations (default: 0, no prefetching)")
+   args = parser.parse_args()
+
+   # User must provide at least one case
+   if not args.case:
+      print("Error: at least one case parameter file must be provided.")
+      sys.exit(1)
+
+   # User must provide at least one quantity or budget
+   if not (args.budget or args.quantity):
+      print("Error: at least one quantity or budget must be provided.")
+      sys.exit(1)
+
+   # Expand the glob patterns, keep the order and drop duplicates
+   configs = []
+   for pattern in args.case:
+      for config in (sorted(glob(pattern)) or [pattern]):
+         if config not in configs:
+            configs.append(config)
+
+   # Read the quantity and budget config files and check their dependencies once
+   graph = builder(None, args.quantity, args.budget)
+   if args.verbose:
+      print(graph)
+      print("Number of case(s): " + np.str(len(configs)))
+      for config in configs:
+         print("   " + config)
+
+   # Process all cases in parallel, the options are passed explicitly to the worker processes
+   options = dict(rawdtype=args.rawdtype, dtype=args.dtype, compensated=args.compensated, order=args.order, \
+                  quadrature=args.quadrature, prefetch=args.prefetch)
+   process_case = partial(sweep_case, quantities=args.quantity, budgets=args.budget, xy=args.xyval, ij=args.ijval, options=options)
+   with ProcessPoolExecutor(args.nworkers) as pool:
+      results = list(pool.map(process_case, configs))
+
+   # Consolidated summary table, one line per case
+   header = ["case", "Ra", "Pr"]
+   for config, ra, pr, columns in results:
+      for label, value in columns:
+         if label not in header:
+            header.append(label)
+   table = [header]
+   for config, ra, pr, columns in results:
+      row = dict(columns)
+      table.append([config, np.str(ra), np.str(pr)] + [np.str(row.get(label, "")) for label in header[3:]])
+   for line in table:
+      print(" | ".join(line))
+   if args.output:
+      with open(args.output, "w") as csv:
+         for line in table:
+            csv.write(",".join('"' + field + '"' for field in line) + "\n")
+
+if __name__ == "__main__":
+   main()
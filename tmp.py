@@ -9,8 +9,14 @@ from module import *
 
 #
 # Read parameters for the present case
+#   In lazy mode, quantities and budgets are only loaded when used
 #
-case = setup(r"case_ra_1e8_lin.dat")
+case = setup(r"case_ra_1e8_lin.dat", lazy=True)
+
+# Build all the quantities and budgets in parallel beforehand
+if False:
+   from glob import glob
+   builder(case, glob("qty_*.dat"), glob("bud_*.dat")).run()
 
 # Load quantities <U>, <V>, <W>, <P> and <T>
 u = quantity(case, "qty_u.dat")